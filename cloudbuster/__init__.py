@@ -1,4 +1,6 @@
 from .query_rf import query_rf
 from .filter import filter_response
+from .filter_batch import filter_batch
+from .local_clouds import local_clouds
 from .gather import gather
 from .merge import merge
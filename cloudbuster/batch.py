@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import os
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+# Submissions to AWS Batch are made in-process, through a single
+# client, rather than by shelling out to the AWS CLI once per job.
+# Throttling and transient errors are retried by botocore with
+# exponential backoff.
+
+
+class BatchClient:
+
+    def __init__(self, max_attempts: int = 10, client=None):
+        if client is None:
+            import boto3
+            import botocore.config
+            config = botocore.config.Config(retries={
+                'max_attempts': max_attempts,
+                'mode': 'adaptive',
+            })
+            client = boto3.client('batch', config=config)
+        self.client = client
+
+    # Submit a job (or, if `array_size` is given, an array job) and
+    # return its id
+    def submit(self,
+               job_name: str,
+               job_queue: str,
+               job_definition: str,
+               command: List[str],
+               vcpus: int,
+               memory: int,
+               array_size: Optional[int] = None,
+               depends_on: Optional[List[str]] = None) -> str:
+        return self.client.submit_job(**submission(job_name, job_queue, job_definition, command,
+                                                   vcpus, memory, array_size, depends_on)).get('jobId')
+
+    # The status of a job (e.g. "RUNNING" or "SUCCEEDED"), or None if
+    # Batch no longer knows of it
+    def status(self, job_id: str) -> Optional[str]:
+        jobs = self.client.describe_jobs(jobs=[job_id]).get('jobs')
+        return jobs[0].get('status') if jobs else None
+
+
+# A stand-in for `BatchClient` that records submissions instead of
+# making them, for dry runs and tests
+class RecordingBatchClient:
+
+    def __init__(self, echo: bool = False):
+        self.submissions: List[dict] = []
+        self.echo = echo
+
+    def submit(self,
+               job_name: str,
+               job_queue: str,
+               job_definition: str,
+               command: List[str],
+               vcpus: int,
+               memory: int,
+               array_size: Optional[int] = None,
+               depends_on: Optional[List[str]] = None) -> str:
+        s = submission(job_name, job_queue, job_definition, command,
+                       vcpus, memory, array_size, depends_on)
+        self.submissions.append(s)
+        if self.echo:
+            print(json.dumps(s, sort_keys=True, indent=4, separators=(',', ': ')))
+        return '<{}>'.format(job_name)
+
+    def status(self, job_id: str) -> Optional[str]:
+        return None
+
+
+# The arguments of a `submit_job` call.  Batch array jobs must have
+# between 2 and 10,000 children; a single child is submitted as an
+# ordinary job (which reads index 0 of its manifest).
+def submission(job_name: str,
+               job_queue: str,
+               job_definition: str,
+               command: List[str],
+               vcpus: int,
+               memory: int,
+               array_size: Optional[int] = None,
+               depends_on: Optional[List[str]] = None) -> dict:
+    s: Dict[str, object] = {
+        'jobName': job_name,
+        'jobQueue': job_queue,
+        'jobDefinition': job_definition,
+        'containerOverrides': {
+            'command': list(map(str, command)),
+            'resourceRequirements': [
+                {'type': 'VCPU', 'value': str(vcpus)},
+                {'type': 'MEMORY', 'value': str(memory)},
+            ],
+        },
+    }
+    if array_size is not None and array_size > 1:
+        if array_size > 10000:
+            raise ValueError('array jobs have at most 10000 children')
+        s['arrayProperties'] = {'size': array_size}
+    if depends_on:
+        s['dependsOn'] = list(map(lambda job_id: {'jobId': job_id}, depends_on))
+    return s
+
+
+# A manifest: the per-child arguments of an array job.  If `pack` is
+# more than 1, each child takes that many consecutive entries.
+def manifest_contents(entries: List[dict], pack: int = 1) -> dict:
+    m: dict = {'entries': entries}
+    if pack > 1:
+        m['pack'] = pack
+    return m
+
+
+# Write a manifest to a local file or to S3
+def write_manifest(uri: str, entries: List[dict], pack: int = 1) -> None:
+    text = json.dumps(manifest_contents(entries, pack), sort_keys=True, indent=4, separators=(',', ': '))
+    parsed = urlparse(uri)
+    if parsed.scheme.startswith('s3'):
+        import boto3
+        boto3.client('s3').put_object(Bucket=parsed.netloc,
+                                      Key=parsed.path.lstrip('/'),
+                                      Body=text.encode())
+    else:
+        directory = os.path.dirname(uri)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(uri, 'w') as f:
+            f.write(text)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import sqlite3
+from typing import Iterable, List, Optional
+
+import shapely.geometry  # type: ignore
+import shapely.prepared  # type: ignore
+import shapely.wkb  # type: ignore
+
+try:
+    from .scenes import Scene, iter_response
+except ImportError:
+    from scenes import Scene, iter_response  # type: ignore
+
+# Scenes are kept in one table, indexed by date and cloud cover, and
+# their footprints' bounding boxes are kept in an R-tree with the same
+# ids.
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS scenes (
+           id INTEGER PRIMARY KEY,
+           name TEXT UNIQUE NOT NULL,
+           path TEXT NOT NULL,
+           datetime TEXT NOT NULL,
+           cloud REAL NOT NULL,
+           footprint BLOB NOT NULL,
+           extra TEXT)''',
+    '''CREATE INDEX IF NOT EXISTS scenes_datetime_cloud ON scenes (datetime, cloud)''',
+    '''CREATE INDEX IF NOT EXISTS scenes_path ON scenes (path)''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS footprints USING rtree (
+           id, xmin, xmax, ymin, ymax)''',
+]
+
+
+def open_catalog(filename: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(filename)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+# Add scenes to the catalog, replacing any with the same names.
+# Returns the number of scenes added.
+def ingest(connection: sqlite3.Connection, scenes: Iterable[Scene]) -> int:
+    count = 0
+    with connection:
+        for scene in scenes:
+            row = connection.execute('SELECT id FROM scenes WHERE name = ?', (scene.name,)).fetchone()
+            if row is not None:
+                connection.execute('DELETE FROM scenes WHERE id = ?', row)
+                connection.execute('DELETE FROM footprints WHERE id = ?', row)
+            extra = None if scene.extra is None else json.dumps(scene.extra, sort_keys=True)
+            cursor = connection.execute(
+                'INSERT INTO scenes (name, path, datetime, cloud, footprint, extra) VALUES (?, ?, ?, ?, ?, ?)',
+                (scene.name, scene.path, scene.created_at, scene.cloudy, scene.footprint, extra))
+            (xmin, ymin, xmax, ymax) = scene.shape.bounds
+            connection.execute(
+                'INSERT INTO footprints (id, xmin, xmax, ymin, ymax) VALUES (?, ?, ?, ?, ?)',
+                (cursor.lastrowid, xmin, xmax, ymin, ymax))
+            count += 1
+    return count
+
+
+# The scenes in a file, which may be a saved query response or a STAC
+# ItemCollection
+def read_scenes(filename: str) -> Iterable[Scene]:
+    for (key, value) in iter_response(filename):
+        if key == 'results':
+            yield Scene.from_result(value)
+        elif key == 'features':
+            for item in value:
+                yield Scene.from_item(item)
+
+
+def scene_from_row(row) -> Scene:
+    (name, path, datetime, cloud, footprint, extra) = row
+    return Scene(name=name,
+                 path=path,
+                 created_at=datetime,
+                 cloudy=cloud,
+                 footprint=footprint,
+                 extra=None if extra is None else json.loads(extra))
+
+
+# Answer a STAC search body (as built by query_rf) from the catalog: the
+# "intersects" geometry, the "datetime" range, and "gte", "lte" and
+# "eq" conditions on eo:cloud_cover and the sentinel:utm_zone,
+# sentinel:latitude_band and sentinel:grid_square of the tile.  Scenes
+# come newest first, as from the server.
+def search(connection: sqlite3.Connection, body: dict, limit: Optional[int] = None) -> List[Scene]:
+    clauses = []
+    parameters: list = []
+
+    if 'datetime' in body:
+        (start, end) = body.get('datetime').split('/')
+        clauses.append('s.datetime >= ? AND substr(s.datetime, 1, ?) <= ?')
+        parameters.extend([start, len(end), end])
+
+    query = body.get('query', {})
+    clouds = query.get('eo:cloud_cover', {})
+    for (op, sql) in [('gte', '>='), ('lte', '<='), ('eq', '=')]:
+        if op in clouds:
+            clauses.append('s.cloud {} ?'.format(sql))
+            parameters.append(clouds.get(op))
+
+    tile = []
+    for field in ['sentinel:utm_zone', 'sentinel:latitude_band', 'sentinel:grid_square']:
+        if 'eq' in query.get(field, {}):
+            tile.append(str(query.get(field).get('eq')))
+    if len(tile) == 3:
+        clauses.append('s.path LIKE ?')
+        parameters.append('tiles/{}/%'.format('/'.join(tile)))
+
+    geometry = None
+    if 'intersects' in body:
+        geometry = shapely.geometry.shape(body.get('intersects'))
+        (xmin, ymin, xmax, ymax) = geometry.bounds
+        clauses.append('s.id IN (SELECT id FROM footprints WHERE xmax >= ? AND xmin <= ? AND ymax >= ? AND ymin <= ?)')
+        parameters.extend([xmin, xmax, ymin, ymax])
+
+    sql = 'SELECT s.name, s.path, s.datetime, s.cloud, s.footprint, s.extra FROM scenes s'
+    if len(clauses) > 0:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY s.datetime DESC, s.name'
+
+    prepared = None if geometry is None else shapely.prepared.prep(geometry)
+    scenes = []
+    for row in connection.execute(sql, parameters):
+        scene = scene_from_row(row)
+        if prepared is not None and not prepared.intersects(scene.shape):
+            continue
+        scenes.append(scene)
+        if limit is not None and len(scenes) >= limit:
+            break
+    return scenes
+
+
+if __name__ == '__main__':
+    import argparse
+
+    def cli_parser() -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--catalog', required=True, type=str,
+                            help='The SQLite database')
+        parser.add_argument('--ingest', required=True, nargs='+', type=str,
+                            help='Saved query responses and/or STAC ItemCollections')
+        return parser
+
+    args = cli_parser().parse_args()
+
+    connection = open_catalog(args.catalog)
+    for filename in args.ingest:
+        print('{}: {} scenes'.format(filename, ingest(connection, read_scenes(filename))))
+    print('{} scenes in catalog'.format(
+        connection.execute('SELECT COUNT(*) FROM scenes').fetchone()[0]))
+    connection.close()
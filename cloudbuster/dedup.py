@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import math
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import rasterio as rio
+import rasterio.errors
+import rasterio.windows
+
+try:
+    from .filter import target_grid
+    from .merge import copy_uri, vsi_uri
+except ImportError:
+    from filter import target_grid  # type: ignore
+    from merge import copy_uri, vsi_uri  # type: ignore
+
+BLOCK_ROWS = 512
+
+# AOIs produced by split_aois.py or divide.py often overlap the same
+# MGRS tiles on the same dates, so that their filtered responses select
+# many of the same scenes.  Rather than gathering such a scene once per
+# AOI, a plan gathers it once over the union of the bounds of the AOIs
+# that selected it; each AOI then cuts its window out of the shared
+# image.  All of the AOIs that share scenes (directly or through other
+# AOIs) are put on one grid so that the cuts are plain copies.
+
+
+def union_bounds(boundss: List[List[float]]) -> List[float]:
+    return [
+        min(map(lambda b: b[0], boundss)),
+        min(map(lambda b: b[1], boundss)),
+        max(map(lambda b: b[2], boundss)),
+        max(map(lambda b: b[3], boundss)),
+    ]
+
+
+# The bounds of the footprint of a selection, if it has one
+def footprint_bounds(selection: dict) -> Optional[List[float]]:
+    footprint = selection.get('dataFootprint')
+    if footprint is None:
+        return None
+    coordinates = np.array(list(points(footprint.get('coordinates'))))
+    return [
+        float(coordinates[:, 0].min()),
+        float(coordinates[:, 1].min()),
+        float(coordinates[:, 0].max()),
+        float(coordinates[:, 1].max()),
+    ]
+
+
+# The positions in the (nested) coordinates of a GeoJSON geometry
+def points(coordinates):
+    if len(coordinates) > 0 and isinstance(coordinates[0], (int, float)):
+        yield coordinates[0:2]
+    else:
+        for c in coordinates:
+            yield from points(c)
+
+
+# The plan for the given filtered responses (a dictionary from the
+# name of each AOI to its response).  Selections are identified by the
+# path of their scene and whether they are backstops.  The gathers of
+# the plan are numbered from `index_start` and named after `name`; the
+# cuts of each AOI keep the indices that the AOI gave its selections.
+def plan_gathers(name: str, responses: Dict[str, dict], index_start: int = 1) -> dict:
+    aois = sorted(responses.keys())
+    keys: List[tuple] = []
+    members: Dict[tuple, List[tuple]] = {}
+    footprints: Dict[tuple, Optional[List[float]]] = {}
+    for aoi in aois:
+        selections = responses.get(aoi).get('selections')
+        for (i, selection) in enumerate(selections, start=index_start):
+            key = (selection.get('sceneMetadata').get('path'), selection.get('backstop', False))
+            if key not in members:
+                keys.append(key)
+                members[key] = []
+                footprints[key] = footprint_bounds(selection)
+            members[key].append((aoi, i))
+
+    # AOIs that share a scene share a grid
+    parents = {aoi: aoi for aoi in aois}
+
+    def find(aoi):
+        while parents[aoi] != aoi:
+            parents[aoi] = parents[parents[aoi]]
+            aoi = parents[aoi]
+        return aoi
+
+    for key in keys:
+        [first, *rest] = map(lambda member: member[0], members.get(key))
+        for aoi in rest:
+            parents[find(aoi)] = find(first)
+    components: Dict[str, List[str]] = {}
+    for aoi in aois:
+        components.setdefault(find(aoi), []).append(aoi)
+    grids = {}
+    for component in components.values():
+        grid = target_grid(union_bounds(list(map(lambda aoi: responses.get(aoi).get('bounds'), component))))
+        for aoi in component:
+            grids[aoi] = grid
+
+    plan: dict = {
+        'name': name,
+        'gathers': [],
+        'aois': {aoi: {'bounds': responses.get(aoi).get('bounds'), 'grid': grids.get(aoi), 'cuts': []} for aoi in aois},
+    }
+    for (index, key) in enumerate(keys, start=index_start):
+        (sentinel_path, backstop) = key
+        aoi_names = list(map(lambda member: member[0], members.get(key)))
+        bounds = union_bounds(list(map(lambda aoi: responses.get(aoi).get('bounds'), aoi_names)))
+        footprint = footprints.get(key)
+        if footprint is not None:
+            bounds = [
+                max(bounds[0], footprint[0]),
+                max(bounds[1], footprint[1]),
+                min(bounds[2], footprint[2]),
+                min(bounds[3], footprint[3]),
+            ]
+        plan['gathers'].append({
+            'backstop': backstop,
+            'bounds': bounds,
+            'grid': grids.get(aoi_names[0]),
+            'index': index,
+            'sentinel_path': sentinel_path,
+        })
+        for (aoi, i) in members.get(key):
+            plan['aois'][aoi]['cuts'].append({
+                'backstop': backstop,
+                'gather': index,
+                'index': i,
+            })
+    return plan
+
+
+def gathered_filename(name: str, index: int, backstop: bool) -> str:
+    name_pattern = '{}-{:02d}'.format(name, index)
+    return 'backstop-{}.tif'.format(name_pattern) if backstop else '{}.tif'.format(name_pattern)
+
+
+# Copy the part of a gathered image (the source) that covers `bounds`
+# into `filename`, marking the pixels that it supplies with `index`
+# rather than with the index of the shared gather.  The bounds are
+# snapped outward onto the grid just as gather snaps them, so that the
+# cut matches the image that a gather for the AOI alone would have
+# produced.  Returns False if the source does not cover the bounds.
+def cut(source: str, filename: str, bounds: List[float], grid: List[float], index: int) -> bool:
+    [xorigin, yorigin, xres, yres] = grid
+    [xmin, ymin, xmax, ymax] = bounds
+    xmin = xorigin + math.floor((xmin - xorigin) / xres) * xres
+    xmax = xorigin + math.ceil((xmax - xorigin) / xres) * xres
+    ymin = yorigin - math.ceil((yorigin - ymin) / yres) * yres
+    ymax = yorigin - math.floor((yorigin - ymax) / yres) * yres
+    with rio.open(source, 'r') as ds:
+        col_off = max(0, round((xmin - ds.bounds.left) / xres))
+        col_end = min(ds.width, round((xmax - ds.bounds.left) / xres))
+        row_off = max(0, round((ds.bounds.top - ymax) / yres))
+        row_end = min(ds.height, round((ds.bounds.top - ymin) / yres))
+        if col_end <= col_off or row_end <= row_off:
+            return False
+        window = rasterio.windows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+        profile = {
+            'driver': 'GTiff',
+            'dtype': ds.dtypes[0],
+            'count': ds.count,
+            'crs': ds.crs,
+            'transform': ds.window_transform(window),
+            'width': window.width,
+            'height': window.height,
+            'nodata': 0,
+            'compress': 'deflate',
+            'predictor': 2,
+            'tiled': True,
+            'bigtiff': 'YES',
+            'sparse_ok': True,
+        }
+        with rio.open(filename, 'w', **profile) as out_ds:
+            for row in range(0, window.height, BLOCK_ROWS):
+                rows = min(BLOCK_ROWS, window.height - row)
+                block = rasterio.windows.Window(col_off, row_off + row, window.width, rows)
+                data = ds.read(window=block)
+                data[ds.count - 1] = (data[ds.count - 1] != 0) * index
+                out_ds.write(data, window=rasterio.windows.Window(0, row, window.width, rows))
+    return True
+
+
+# Cut the images of the given AOI out of the shared images under
+# `shared_path`, saving them under `output_path` with the names that a
+# gather for the AOI alone would have given them.  Returns the number
+# of cuts that failed.
+def cut_aoi(plan: dict, aoi: str, shared_path: str, output_path: str, working_dir: str = '/tmp') -> int:
+    failures = 0
+    entry = plan.get('aois').get(aoi)
+    for c in entry.get('cuts'):
+        source = vsi_uri(shared_path + gathered_filename(plan.get('name'), c.get('gather'), c.get('backstop')))
+        filename = os.path.join(working_dir, gathered_filename(aoi, c.get('index'), c.get('backstop')))
+        try:
+            if not cut(source, filename, entry.get('bounds'), entry.get('grid'), c.get('index')):
+                continue
+        except rio.errors.RasterioIOError as e:
+            print('{}: {}'.format(source, e))
+            failures = failures + 1
+            continue
+        if copy_uri(filename, output_path) != 0:
+            failures = failures + 1
+        os.remove(filename)
+    return failures
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    def cli_parser() -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--plan', required=True, type=str,
+                            help='The plan to write (with --responses) or to cut according to')
+        parser.add_argument('--responses', required=False, nargs='+', type=str,
+                            help='The filtered responses of the AOIs, each named after its file')
+        parser.add_argument('--name', required=False, default='shared', type=str,
+                            help='The name of the shared gathers')
+        parser.add_argument('--index-start', required=False, default=1, type=int)
+        parser.add_argument('--shared-path', required=False, type=str,
+                            help='Where the shared gathers put their images')
+        parser.add_argument('--output-path', required=False, type=str,
+                            help='Where to put the cuts of each AOI (under OUTPUT_PATH/AOI/)')
+        parser.add_argument('--aoi', required=False, nargs='+', type=str,
+                            help='The AOIs to cut (by default all of them)')
+        parser.add_argument('--tmp', required=False, default='/tmp', type=str)
+        return parser
+
+    parser = cli_parser()
+    args = parser.parse_args()
+    if (args.shared_path is None) != (args.output_path is None):
+        parser.error('--shared-path and --output-path go together')
+    if args.responses is None and args.shared_path is None:
+        parser.error('--responses or --shared-path is required')
+
+    if args.responses is not None:
+        responses = {}
+        for filename in args.responses:
+            with open(filename, 'r') as f:
+                responses[os.path.splitext(os.path.basename(filename))[0]] = json.load(f)
+        plan = plan_gathers(args.name, responses, index_start=args.index_start)
+        with open(args.plan, 'w') as f:
+            json.dump(plan, f, sort_keys=True, indent=4, separators=(',', ': '))
+        selections = sum(map(lambda r: len(r.get('selections')), responses.values()))
+        print('{} selections from {} AOIs, {} gathers ({:.2f}x)'.format(
+            selections, len(responses), len(plan.get('gathers')),
+            selections / max(1, len(plan.get('gathers')))))
+    else:
+        with open(args.plan, 'r') as f:
+            plan = json.load(f)
+
+    if args.shared_path is not None:
+        failures = 0
+        for aoi in args.aoi or sorted(plan.get('aois').keys()):
+            failures = failures + cut_aoi(plan, aoi, args.shared_path,
+                                          '{}{}/'.format(args.output_path, aoi), working_dir=args.tmp)
+        if failures > 0:
+            print('{} cuts failed'.format(failures))
+            sys.exit(-1)
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import concurrent.futures
+import copy
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+from typing import List, Optional
+
+try:
+    from .batch import BatchClient, RecordingBatchClient, manifest_contents, write_manifest
+    from .sizing import gather_pack, gather_resources, merge_resources, read_metrics, window_pixels
+except ImportError:
+    from batch import BatchClient, RecordingBatchClient, manifest_contents, write_manifest  # type: ignore
+    from sizing import gather_pack, gather_resources, merge_resources, read_metrics, window_pixels  # type: ignore
+
+# Executors run the jobs of the meta-* scripts either on AWS Batch or
+# in a local process pool.  A job names a function (for local
+# execution) and a container command (for Batch) that do the same
+# work; an array job has one child per entry of `array`, each of which
+# is merged into the keyword arguments of the function (or, on Batch,
+# found by the children in a manifest or through their array index).
+# On Batch, the entries of an array job may be packed: each child then
+# takes `pack` consecutive entries, which it runs one after another.
+
+
+class Job:
+    __slots__ = ('name', 'function', 'kwargs', 'command', 'vcpus', 'memory',
+                 'array', 'manifest', 'scratch_arg', 'depends_on', 'pack')
+
+    def __init__(self,
+                 name: str,
+                 function: str,
+                 kwargs: dict,
+                 command: List[str],
+                 vcpus: int = 1,
+                 memory: int = 2000,
+                 array: Optional[List[dict]] = None,
+                 manifest: Optional[str] = None,
+                 scratch_arg: Optional[str] = None,
+                 depends_on: Optional[list] = None,
+                 pack: int = 1):
+        self.name = name
+        self.function = function  # e.g. "cloudbuster.merge.merge"
+        self.kwargs = kwargs
+        self.command = command
+        self.vcpus = vcpus
+        self.memory = memory  # MB
+        self.array = array
+        self.manifest = manifest
+        self.scratch_arg = scratch_arg  # The argument that receives a scratch directory
+        self.depends_on = depends_on or []
+        self.pack = pack
+
+    # The names and keyword arguments of the children of the job (just
+    # the job itself if it is not an array job)
+    def children(self) -> List[tuple]:
+        if self.array is None:
+            return [(self.name, self.kwargs)]
+        children = []
+        for (i, entry) in enumerate(self.array):
+            kwargs = copy.copy(self.kwargs)
+            kwargs.update(entry)
+            children.append(('{}-{}'.format(self.name, i), kwargs))
+        return children
+
+
+class BatchExecutor:
+    asynchronous = True
+
+    def __init__(self, job_queue: str, job_definition: str, dryrun: bool = False, client=None):
+        self.job_queue = job_queue
+        self.job_definition = job_definition
+        self.dryrun = dryrun
+        if client is None:
+            client = RecordingBatchClient(echo=True) if dryrun else BatchClient()
+        self.client = client
+
+    # Submit the job and return its id.  Batch resolves dependencies
+    # itself.
+    def submit(self, job: Job) -> str:
+        if job.manifest is not None and self.dryrun:
+            print(json.dumps(manifest_contents(job.array, job.pack), sort_keys=True, indent=4, separators=(',', ': ')))
+        elif job.manifest is not None:
+            write_manifest(job.manifest, job.array, pack=job.pack)
+        return self.client.submit(job.name,
+                                  self.job_queue,
+                                  self.job_definition,
+                                  job.command,
+                                  vcpus=job.vcpus,
+                                  memory=job.memory,
+                                  array_size=-(-len(job.array) // job.pack) if job.array is not None else None,
+                                  depends_on=job.depends_on)
+
+    # Jobs on Batch are not waited for
+    def wait(self, handle: str, callback=None) -> list:
+        return []
+
+    # The status of a job that was submitted earlier (e.g. "RUNNING"),
+    # if it is known
+    def status(self, handle: str) -> Optional[str]:
+        return self.client.status(handle)
+
+    def shutdown(self) -> None:
+        pass
+
+
+# The total memory of the machine, in MB
+def machine_memory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1 << 20)
+
+
+def machine_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# Each worker of the pool takes a slot, which determines the CPUs that
+# it is pinned to
+def init_worker(slots, vcpus: int) -> None:
+    try:
+        slot = slots.get_nowait()
+    except Exception:
+        return
+    cpus = machine_cpus()[slot*vcpus:(slot+1)*vcpus]
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'GDAL_NUM_THREADS']:
+        os.environ[variable] = str(vcpus)
+
+
+# Run one (child of a) job in a worker, within its memory limit and in
+# a scratch directory of its own, which is removed afterwards
+def run_job(function: str, kwargs: dict, memory: Optional[int], scratch: Optional[str], keep_scratch: bool):
+    if memory is not None:
+        import resource
+        (_, hard) = resource.getrlimit(resource.RLIMIT_DATA)
+        limit = memory * (1 << 20)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+    (module, attribute) = function.rsplit('.', 1)
+    # Outside of the package (as from the scripts in python/), the
+    # job's module is imported the same way
+    if not __package__:
+        module = module.rsplit('.', 1)[-1]
+    f = getattr(importlib.import_module(module), attribute)
+    try:
+        return f(**kwargs)
+    finally:
+        if scratch is not None and not keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+class LocalHandle:
+
+    def __init__(self, futures: list):
+        self.futures = futures
+
+    # The results of the children, in order.  Raises the first error.
+    def result(self) -> list:
+        return list(map(lambda future: future.result(), self.futures))
+
+
+class LocalExecutor:
+    asynchronous = False
+
+    # Jobs run in a process pool whose size is the number of jobs of
+    # the given size (in CPUs and MB) that fit on the machine, capped
+    # at `workers`.  Scratch directories are made under `scratch_root`.
+    def __init__(self,
+                 vcpus: int = 1,
+                 memory: Optional[int] = None,
+                 workers: Optional[int] = None,
+                 scratch_root: str = '/tmp',
+                 keep_scratch: bool = False,
+                 limit_memory: bool = True,
+                 dryrun: bool = False):
+        cpus = machine_cpus()
+        slots = max(1, len(cpus) // vcpus)
+        if memory is not None:
+            slots = min(slots, max(1, machine_memory() // memory))
+        if workers is not None:
+            slots = min(slots, workers)
+        self.workers = slots
+        self.vcpus = vcpus
+        self.memory = memory
+        self.scratch_root = scratch_root
+        self.keep_scratch = keep_scratch
+        self.limit_memory = limit_memory
+        self.dryrun = dryrun
+
+        queue = multiprocessing.Queue()
+        for slot in range(slots):
+            queue.put(slot)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=slots,
+                                                           initializer=init_worker,
+                                                           initargs=(queue, vcpus))
+
+    # Submit the children of the job to the pool once the jobs that it
+    # depends on have finished
+    def submit(self, job: Job) -> LocalHandle:
+        for handle in job.depends_on:
+            handle.result()
+        if job.vcpus > self.vcpus or (self.memory is not None and job.memory > self.memory):
+            raise ValueError('{} does not fit in a worker'.format(job.name))
+        futures = []
+        for (name, kwargs) in job.children():
+            if self.dryrun:
+                print(json.dumps({'function': job.function, 'kwargs': kwargs},
+                                 sort_keys=True, indent=4, separators=(',', ': ')))
+                continue
+            scratch = None
+            if job.scratch_arg is not None:
+                scratch = os.path.join(self.scratch_root, name)
+                os.makedirs(scratch, exist_ok=True)
+                kwargs = copy.copy(kwargs)
+                kwargs[job.scratch_arg] = scratch
+            memory = job.memory if self.limit_memory else None
+            futures.append(self.pool.submit(run_job, job.function, kwargs, memory, scratch, self.keep_scratch))
+        return LocalHandle(futures)
+
+    # The results of the children of the job.  If a callback is given,
+    # it is instead called with the position and future of each child
+    # as it finishes, and errors are left to it.
+    def wait(self, handle: LocalHandle, callback=None) -> list:
+        if callback is None:
+            return handle.result()
+        positions = dict(map(lambda i: (handle.futures[i], i), range(len(handle.futures))))
+        for future in concurrent.futures.as_completed(handle.futures):
+            callback(positions.get(future), future)
+        return []
+
+    # Jobs of earlier runs are no longer running
+    def status(self, handle) -> Optional[str]:
+        return None
+
+    def shutdown(self) -> None:
+        self.pool.shutdown()
+
+
+# The job that gathers the given selections.  Each entry gives the
+# index, sentinel_path and backstop of a selection (and possibly its
+# own bounds and grid); children of the job on Batch find theirs in
+# the manifest.  Unless they are given, the CPUs and memory of the job
+# and the number of selections packed into each child on Batch are
+# estimated (see sizing.py), with corrections from the records of
+# earlier gathers under `metrics`, to which the children add their own.
+def gather_job(name: str,
+               output_path: str,
+               entries: List[dict],
+               gather: Optional[str] = None,
+               manifest: Optional[str] = None,
+               bounds: Optional[List[float]] = None,
+               grid: Optional[List[float]] = None,
+               architecture: Optional[str] = None,
+               weights: Optional[str] = None,
+               kind: str = 'L1C',
+               donate_mask: bool = False,
+               donor_mask: Optional[str] = None,
+               donor_mask_name: Optional[str] = None,
+               cog: bool = False,
+               tmp: str = '/tmp',
+               metrics: Optional[str] = None,
+               vcpus: Optional[int] = None,
+               memory: Optional[int] = None,
+               pack: Optional[int] = None) -> Job:
+    inference = architecture is not None and weights is not None and donor_mask is None
+    records = read_metrics(metrics) if None in [vcpus, memory, pack] else []
+    if vcpus is None or memory is None:
+        window = max(map(lambda entry: window_pixels(entry.get('bounds', bounds), entry.get('grid', grid)), entries))
+        (sized_vcpus, sized_memory) = gather_resources(kind, inference, window, records=records)
+        vcpus = vcpus or sized_vcpus
+        memory = memory or sized_memory
+    if pack is None:
+        pack = gather_pack(kind, inference, records=records)
+    if manifest is None:
+        manifest = '{}{}-gather-manifest.json'.format(output_path, name)
+    kwargs = {
+        'output_s3_uri': output_path,
+        'name': name,
+        'architecture': architecture,
+        'weights': weights,
+        'bounds': bounds,
+        'grid': grid,
+        'kind': kind,
+        'donate_mask': donate_mask,
+        'donor_mask': donor_mask,
+        'donor_mask_name': donor_mask_name,
+        'cog': cog,
+        'metrics': metrics,
+    }
+    command = [
+        './download_run.sh', gather,
+        '--name', name,
+        '--output-path', output_path,
+        '--manifest', manifest,
+    ]
+    if architecture is not None:
+        command += ['--architecture', architecture]
+    if weights is not None:
+        command += ['--weights', weights]
+    if bounds is not None:
+        command += ['--bounds'] + list(bounds)
+    if grid is not None:
+        command += ['--grid'] + list(grid)
+    command += [
+        '--kind', kind,
+        '--donor-mask', donor_mask,
+        '--donor-mask-name', donor_mask_name,
+        '--donate-mask', donate_mask,
+        '--tmp', tmp,
+        '--cog', cog,
+    ]
+    if metrics is not None:
+        command += ['--metrics', metrics]
+    return Job('{}-GATHER'.format(name),
+               'cloudbuster.gather.gather',
+               kwargs,
+               command,
+               vcpus=vcpus,
+               memory=memory,
+               array=entries,
+               manifest=manifest,
+               scratch_arg='working_dir',
+               pack=min(pack, max(1, len(entries))))
+
+
+# The jobs that merge the gathered images: the merge (an array job of
+# one child per shard if sharded) and, if sharded, the assembly of the
+# shards, which must be made to depend on the merge.  The merge is
+# sized like a gather, from the number of `inputs` (if known) and the
+# size of its shards.
+def merge_jobs(name: str,
+               input_path: str,
+               output_path: str,
+               merge: Optional[str] = None,
+               bounds: Optional[List[float]] = None,
+               shards: int = 1,
+               assemble_format: str = 'vrt',
+               cog: bool = False,
+               vrt: bool = False,
+               tmp: str = '/tmp',
+               inputs: Optional[int] = None,
+               metrics: Optional[str] = None,
+               vcpus: Optional[int] = None,
+               memory: Optional[int] = None) -> List[Job]:
+    if vcpus is None or memory is None:
+        (sized_vcpus, sized_memory) = merge_resources(inputs or 16, window_pixels(bounds, None, shards),
+                                                      cog=cog, records=read_metrics(metrics))
+        vcpus = vcpus or sized_vcpus
+        memory = memory or sized_memory
+    command = [
+        './download_run.sh', merge,
+        '--input-path', input_path,
+        '--name', name,
+        '--output-path', output_path,
+    ]
+    if bounds is not None:
+        command += ['--bounds'] + list(bounds)
+    command += [
+        '--shards', shards,
+        '--cog', cog,
+        '--vrt', vrt,
+        '--tmp', tmp,
+    ]
+    if metrics is not None:
+        command += ['--metrics', metrics]
+    jobs = [Job('{}-MERGE'.format(name),
+                'cloudbuster.merge.merge',
+                {
+                    'name': name,
+                    'input_s3_uri': input_path,
+                    'output_s3_uri': output_path,
+                    'bounds': bounds,
+                    'shards': shards,
+                    'cog': cog,
+                    'vrt': vrt,
+                    'metrics': metrics,
+                },
+                command,
+                vcpus=vcpus,
+                memory=memory,
+                array=[{'shard': shard} for shard in range(shards)] if shards > 1 else None,
+                scratch_arg='local_working_dir')]
+    if shards > 1:
+        jobs.append(Job('{}-ASSEMBLE'.format(name),
+                        'cloudbuster.merge.assemble',
+                        {
+                            'name': name,
+                            'shards': shards,
+                            'output_s3_uri': output_path,
+                            'assemble_format': assemble_format,
+                        },
+                        [
+                            './download_run.sh', merge,
+                            '--name', name,
+                            '--output-path', output_path,
+                            '--shards', shards,
+                            '--assemble', True,
+                            '--assemble-format', assemble_format,
+                            '--tmp', tmp,
+                        ],
+                        vcpus=2,
+                        memory=4000,
+                        scratch_arg='local_working_dir'))
+    return jobs
+
+
+# Submit jobs, each depending on the one before it (in addition to
+# any dependencies of its own), and return the handle of the last
+def submit_chain(executor, jobs: List[Job]):
+    handle = None
+    for job in jobs:
+        if handle is not None:
+            job.depends_on = job.depends_on + [handle]
+        handle = executor.submit(job)
+    return handle
@@ -26,12 +26,149 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import copy
+import collections
+import heapq
+import json
+import math
 import re
+from typing import List
 
+import numpy as np
+import rasterio.features
+import rasterio.transform
 import shapely.affinity  # type: ignore
 import shapely.geometry  # type: ignore
 import shapely.ops  # type: ignore
+import shapely.prepared  # type: ignore
+import shapely.strtree  # type: ignore
+
+try:
+    from .scenes import Scene, read_response
+except ImportError:
+    from scenes import Scene, read_response  # type: ignore
+
+# Areas within this (relative) distance of each other are treated as
+# tied by the lazy engine, since areas of intersection computed against
+# a smaller residual shape can come out larger in the last place
+TIE_EPSILON = 1e-9
+
+# The number of set bits in each possible byte
+POPCOUNT = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+
+# A grid (origin and resolution, in EPSG:4326) shared by all of the
+# imagery gathered for the given bounds.  The resolution matches that
+# of 10m bands at the latitude in the bounds that is farthest from the
+# equator, and the origin lies on a multiple of the resolution so that
+# gdalwarp's -tap option snaps onto the grid.
+def target_grid(bounds: List[float], pixel_size: float = 10.0) -> List[float]:
+    [xmin, ymin, xmax, ymax] = bounds
+    y = math.cos(math.radians(max(abs(ymin), abs(ymax))))
+    xres = (1.0/y) * (1.0/110000) * pixel_size
+    yres = (1.0/110000) * pixel_size
+    xorigin = math.floor(xmin / xres) * xres
+    yorigin = math.ceil(ymax / yres) * yres
+    return [xorigin, yorigin, xres, yres]
+
+
+# Indices of the geometries in the tree whose envelopes intersect that
+# of the given geometry.  (Shapely 1.8 returns geometries from query(),
+# but indices from query_items().)
+def strtree_query(tree, geometry):
+    if hasattr(tree, 'query_items'):
+        return tree.query_items(geometry)
+    return tree.query(geometry)
+
+
+def popcount(bits: np.ndarray) -> int:
+    return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+
+# Rasterize the AOI and the given shapes onto a grid of the given
+# resolution (in degrees) that covers the bounds of the AOI.  Pixels
+# are bit-packed along rows.  Each shape is clipped to the AOI and
+# stored as the first row of its window together with the packed rows
+# of that window (or None if it misses the AOI entirely).
+def raster_bits(aoi, shapes, resolution: float):
+    (xmin, ymin, xmax, ymax) = aoi.bounds
+    width = max(1, int(math.ceil((xmax - xmin) / resolution)))
+    height = max(1, int(math.ceil((ymax - ymin) / resolution)))
+    transform = rasterio.transform.from_origin(xmin, ymax, resolution, resolution)
+
+    aoi_mask = rasterio.features.rasterize(
+        [(aoi, 1)], out_shape=(height, width), transform=transform,
+        fill=0, dtype=np.uint8).astype(bool)
+    aoi_bits = np.packbits(aoi_mask, axis=1)
+
+    footprints = []
+    for shape in shapes:
+        (_, sy0, _, sy1) = shape.bounds
+        row0 = max(0, int(math.floor((ymax - sy1) / resolution)))
+        row1 = min(height, int(math.ceil((ymax - sy0) / resolution)))
+        if row1 <= row0:
+            footprints.append(None)
+            continue
+        mask = rasterio.features.rasterize(
+            [(shape, 1)], out_shape=(row1 - row0, width),
+            transform=transform * rasterio.transform.Affine.translation(0, row0),
+            fill=0, dtype=np.uint8).astype(bool)
+        mask &= aoi_mask[row0:row1]
+        if not mask.any():
+            footprints.append(None)
+            continue
+        footprints.append((row0, np.packbits(mask, axis=1)))
+
+    return aoi_bits, footprints, resolution * resolution
+
+
+# For k = 1 .. coverage_count, the exact area of the AOI that is
+# covered fewer than k times by the given shapes
+def coverage_deficit(aoi, shapes, coverage_count: int) -> List[float]:
+    covered = [shapely.geometry.Polygon()] * coverage_count
+    for shape in shapes:
+        clipped = shape.intersection(aoi)
+        for k in reversed(range(coverage_count)):
+            if k == 0:
+                below = clipped
+            else:
+                below = covered[k - 1].intersection(clipped)
+            covered[k] = covered[k].union(below)
+    return list(map(lambda c: aoi.area - c.area, covered))
+
+
+# Run the raster engine and a vector engine on the same response and
+# compare their selections and the exact residual areas of each.
+def tolerance_report(response, engine='lazy', raster_resolution=0.01, **kwargs) -> dict:
+    aoi = shapely.geometry.shape(response.get('aoi'))
+    coverage_count = kwargs.get('coverage_count', 3)
+    report = {'resolution': raster_resolution, 'engines': {}}
+    names = {}
+
+    for e in [engine, 'raster']:
+        selections, not_backstopped, not_covered = filter_response(
+            response, engine=e,
+            raster_resolution=raster_resolution, **kwargs)
+        selections = selections.get('selections')
+        names[e] = set(map(lambda s: s.get('name'), selections))
+        primary = [shapely.geometry.shape(s.get('dataFootprint')) for s in selections if not s.get('backstop')]
+        backstop = [shapely.geometry.shape(s.get('dataFootprint')) for s in selections if s.get('backstop')]
+        report['engines'][e] = {
+            'selections': len(selections),
+            'backstops': len(backstop),
+            'not_covered': not_covered,
+            'not_backstopped': not_backstopped,
+            'residual_areas': coverage_deficit(aoi, primary, coverage_count),
+            'backstop_residual_area': coverage_deficit(aoi, backstop, 1)[0],
+        }
+
+    common = names[engine] & names['raster']
+    union = names[engine] | names['raster']
+    report['common_selections'] = len(common)
+    report['jaccard'] = len(common) / len(union) if len(union) > 0 else 1.0
+    report['residual_area_difference'] = [
+        r - v for (r, v) in zip(report['engines']['raster']['residual_areas'],
+                                report['engines'][engine]['residual_areas'])]
+    return report
 
 
 def filter_response(response,
@@ -41,103 +178,360 @@ def filter_response(response,
                     date_regexp=None,
                     name_regexp=None,
                     minclouds=0.0,
-                    max_uncovered=5e-4):
-    results = response.get('results')
-    results = list(filter(lambda s: float(
-        s['sceneMetadata']['cloudyPixelPercentage']) >= minclouds, results))
+                    max_uncovered=5e-4,
+                    engine='exhaustive',
+                    raster_resolution=0.01,
+                    cost=None,
+                    tile_discount=0.0,
+                    date_discount=0.0,
+                    budget=None,
+                    min_gain=0.0):
+    assert engine in ['exhaustive', 'lazy', 'raster']
+    # With discounts, the cost of a candidate can fall as other scenes
+    # are selected, so its score can rise and a stale score is no longer
+    # an upper bound.  Only the exhaustive engine rescores every
+    # candidate.
+    assert cost is None or cost > 0.0
+    assert cost is None or engine == 'exhaustive' or (tile_discount == 0.0 and date_discount == 0.0)
+
+    # The results may be Scenes or dictionaries as found in response
+    # files.  They are not modified.
+    results = list(map(lambda r: r if isinstance(r, Scene) else Scene.from_result(r),
+                       response.get('results')))
+    results = list(filter(lambda s: s.cloudy_pixel_percentage() >= minclouds, results))
 
     if name_regexp:
         results = list(filter(lambda r: re.search(
-            name_regexp, r.get('name')) is not None, results))
+            name_regexp, r.name) is not None, results))
 
     if date_regexp:
         results = list(filter(lambda r: re.search(
-            date_regexp, r.get('createdAt')) is not None, results))
+            date_regexp, r.created_at) is not None, results))
+
+    # Candidates whose envelopes do not meet a residual shape are
+    # rejected by the spatial index, and those that do not actually
+    # intersect it are rejected by a prepared geometry before any exact
+    # intersection is computed.  Such candidates would have scored zero
+    # anyway, so the selections are unaffected.
+    tree = shapely.strtree.STRtree(list(map(lambda r: r.shape, results)))
+    available = set(range(len(results)))
+    ops = collections.Counter()
+
+    def non_cloudy_pct(i):
+        return 1.0 - results[i].cloudy_pixel_percentage()/100.0
+
+    # The (cloud-weighted) area of intersection of a candidate with a
+    # residual shape
+    def evaluate(i, geom, prepared):
+        data_shape = results[i].shape
+        ops['intersects'] += 1
+        if not prepared.intersects(data_shape):
+            return 0.0
+        ops['intersection'] += 1
+        return data_shape.intersection(geom).area * non_cloudy_pct(i)
+
+    # The areas of intersection of the available candidates with a
+    # residual shape, keyed by candidate
+    def column(geom):
+        prepared = shapely.prepared.prep(geom)
+        ops['prepare'] += 1
+        areas = {}
+        for i in map(int, strtree_query(tree, geom)):
+            if i in available:
+                area = evaluate(i, geom, prepared)
+                if area > 0.0:
+                    areas[i] = area
+        return areas
+
+    # The cost model.  Each scene costs the same (e.g. bytes downloaded
+    # or seconds of gather job), less a discount if a scene from the same
+    # MGRS tile and/or the same date has already been selected.
+    # Candidates are then scored by area per unit cost, and those that
+    # would exceed the budget or that score below min_gain are passed
+    # over.
+    tiles = collections.Counter()
+    dates = collections.Counter()
+    spent = [0.0]
+
+    def mgrs_tile(i):
+        path = results[i].path.split('/')
+        return ''.join(path[1:4])
+
+    def scene_date(i):
+        return results[i].created_at[0:10]
 
-    for result in results:
-        result['dataShape'] = shapely.geometry.shape(
-            result.get('dataFootprint'))
+    def cost_of(i):
+        c = cost
+        if tiles[mgrs_tile(i)] > 0:
+            c *= 1.0 - tile_discount
+        if dates[scene_date(i)] > 0:
+            c *= 1.0 - date_discount
+        return c
 
+    def worth(i, area):
+        if cost is None or area <= 0.0:
+            return area
+        c = cost_of(i)
+        if budget is not None and spent[0] + c > budget:
+            return 0.0
+        gain = area / c
+        return gain if gain >= min_gain else 0.0
+
+    # Among the cached areas, find the largest positive one (per unit
+    # cost, if there is a cost model).  Ties go to the earliest
+    # candidate and then the earliest residual shape.
+    def best(columns):
+        i_best = -1
+        j_best = -1
+        area_best = 0.0
+        for (j, areas) in enumerate(columns):
+            for (i, area) in areas.items():
+                area = worth(i, area)
+                if area > area_best or (area == area_best > 0.0 and (i, j) < (i_best, j_best)):
+                    i_best = i
+                    j_best = j
+                    area_best = area
+        return (i_best, j_best, area_best)
+
+    # (Geometries are never modified in place, so every residual shape
+    # can start out as the AOI itself.)
     shape = shapely.geometry.shape(response.get('aoi'))
-    shapes = []
-    for i in range(coverage_count):
-        shapes.append(copy.deepcopy(shape))
-    backstop_geom = copy.deepcopy(shape)
+    shapes = [shape] * coverage_count
+    shape_areas = list(map(lambda s: s.area, shapes))
+    backstop_geom = shape
+    backstop_area = [backstop_geom.area]
 
     selections = []
+    backstops = set()
+    costs = {}
 
     def not_backstopped():
-        area = backstop_geom.area
+        area = backstop_area[0]
         print(area)
         return area > max_uncovered
 
     def not_covered():
-        areas = list(map(lambda s: s.area, shapes))
-        print(areas)
-        return sum(areas) > max_uncovered
+        print(shape_areas)
+        return sum(shape_areas) > max_uncovered
 
     def enough_selected():
         return (max_selections is not None) and (len(selections) > max_selections)
 
-    # Primary coverage
-    while (not_covered()) and (not enough_selected()) and (len(results) > 0):
-        i_best = -1
-        j_best = -1
-        area_best = 0.0
-        for i in range(len(results)):
-            for j in range(len(shapes)):
-                raw_area = results[i].get(
-                    'dataShape').intersection(shapes[j]).area
-                non_cloudy_pct = 1.0 - \
-                    float(results[i].get('sceneMetadata').get(
-                        'cloudyPixelPercentage'))/100.0
-                area = raw_area * non_cloudy_pct
-                if area > area_best:
-                    j_best = j
-                    i_best = i
-                    area_best = area
-        if area_best <= 0.0:
-            break
-        shapes[j_best] = shapes[j_best].difference(
-            results[i_best].get('dataShape'))
-        selections.append(results[i_best])
-        results = results[0:i_best] + results[i_best+1:]
-
-    # Backstop
-    while (not_backstopped() and backstop_bool) and (not enough_selected()) and (len(results) > 0):
-        i_best = -1
-        area_best = 0.0
-        for i in range(len(results)):
-            raw_area = results[i].get('dataShape').intersection(backstop_geom).area
-            non_cloudy_pct = 1.0 - \
-                float(results[i].get('sceneMetadata').get(
-                    'cloudyPixelPercentage'))/100.0
-            area = raw_area * non_cloudy_pct
-            if area > area_best:
-                i_best = i
-                area_best = area
-        if area_best <= 0.0:
-            break
-        backstop_geom = backstop_geom.difference(results[i_best].get('dataShape'))
-        results[i_best]['backstop'] = True
-        selections.append(results[i_best])
-        results = results[0:i_best] + results[i_best+1:]
+    def select(i):
+        if cost is not None:
+            costs[i] = cost_of(i)
+            spent[0] += costs[i]
+            tiles[mgrs_tile(i)] += 1
+            dates[scene_date(i)] += 1
+        selections.append(i)
+        available.remove(i)
+
+    # The lazy engine keeps a heap of (negated) areas, each tagged with
+    # the version of the residual shape it was computed against.  As
+    # residual shapes only shrink, a stale area is an upper bound on
+    # the current one (up to rounding), so only entries that reach the
+    # top of the heap need to be brought up to date.  Before the top is
+    # accepted, every entry whose bound ties with it (within
+    # TIE_EPSILON) is brought up to date too, and the best of those is
+    # chosen by area, then candidate, then residual shape (the order of
+    # the heap), which is how the exhaustive engine chooses.
+    def lazy_heap(columns):
+        heap = []
+        for (j, areas) in enumerate(columns):
+            for (i, area) in areas.items():
+                heap.append((-area, i, j, 0))
+        heapq.heapify(heap)
+        return heap
+
+    def lazy_best(heap, score, versions):
+        best = None
+        passed = []
+        while len(heap) > 0:
+            entry = heap[0]
+            if best is not None and -entry[0] < -best[0] * (1.0 - TIE_EPSILON):
+                break
+            heapq.heappop(heap)
+            (neg_area, i, j, version) = entry
+            if i not in available:
+                continue
+            if version != versions[j]:
+                area = score(i, j)
+                if area > 0.0:
+                    heapq.heappush(heap, (-area, i, j, versions[j]))
+            elif best is None or entry < best:
+                if best is not None:
+                    passed.append(best)
+                best = entry
+            else:
+                passed.append(entry)
+        for entry in passed:
+            heapq.heappush(heap, entry)
+        if best is None:
+            return (-1, -1, 0.0)
+        return (best[1], best[2], -best[0])
+
+    # The raster engine works with bit-packed masks on a grid of the
+    # given resolution instead of residual polygons, so the cost of an
+    # evaluation no longer grows with the complexity of the residuals.
+    # Areas are pixel counts times the area of a pixel, which keeps them
+    # comparable with max_uncovered.  Residual masks only shrink, so
+    # selection uses the lazy heap.
+    if engine == 'raster':
+        (aoi_bits, footprints, pixel_area) = raster_bits(
+            shape, list(map(lambda r: r.shape, results)), raster_resolution)
 
+        def raster_score(i, bits):
+            (row, footprint) = footprints[i]
+            ops['popcount'] += 1
+            count = popcount(footprint & bits[row:row + footprint.shape[0]])
+            return count * pixel_area * non_cloudy_pct(i)
+
+        def raster_column(bits):
+            areas = {}
+            for i in available:
+                if footprints[i] is not None:
+                    area = raster_score(i, bits)
+                    if area > 0.0:
+                        areas[i] = area
+            return areas
+
+        def remove(bits, i):
+            (row, footprint) = footprints[i]
+            bits[row:row + footprint.shape[0]] &= ~footprint
+
+        # Primary coverage
+        residuals = [aoi_bits.copy() for j in range(coverage_count)]
+        shape_areas = list(map(lambda bits: popcount(bits) * pixel_area, residuals))
+        heap = lazy_heap(list(map(raster_column, residuals)))
+        versions = [0] * len(residuals)
+        while (not_covered()) and (not enough_selected()) and (len(available) > 0):
+            (i_best, j_best, area_best) = lazy_best(
+                heap, lambda i, j: raster_score(i, residuals[j]), versions)
+            area_best = worth(i_best, area_best)
+            if area_best <= 0.0:
+                break
+            remove(residuals[j_best], i_best)
+            shape_areas[j_best] = popcount(residuals[j_best]) * pixel_area
+            select(i_best)
+            versions[j_best] += 1
+
+        # Backstop
+        backstop_bits = aoi_bits.copy()
+        backstop_area[0] = popcount(backstop_bits) * pixel_area
+        heap = None
+        versions = [0]
+        while (not_backstopped() and backstop_bool) and (not enough_selected()) and (len(available) > 0):
+            if heap is None:
+                heap = lazy_heap([raster_column(backstop_bits)])
+            (i_best, _, area_best) = lazy_best(
+                heap, lambda i, j: raster_score(i, backstop_bits), versions)
+            area_best = worth(i_best, area_best)
+            if area_best <= 0.0:
+                break
+            remove(backstop_bits, i_best)
+            backstop_area[0] = popcount(backstop_bits) * pixel_area
+            backstops.add(i_best)
+            select(i_best)
+            versions[0] += 1
+    else:
+        # Primary coverage.  Only one residual shape changes per selection,
+        # so only its column of areas is recomputed (exhaustive engine) or
+        # marked as stale (lazy engine).
+        columns = list(map(column, shapes))
+        if engine == 'lazy':
+            heap = lazy_heap(columns)
+            prepared_shapes = list(map(shapely.prepared.prep, shapes))
+            versions = [0] * len(shapes)
+        while (not_covered()) and (not enough_selected()) and (len(available) > 0):
+            if engine == 'lazy':
+                (i_best, j_best, area_best) = lazy_best(
+                    heap, lambda i, j: evaluate(i, shapes[j], prepared_shapes[j]), versions)
+                area_best = worth(i_best, area_best)
+            else:
+                (i_best, j_best, area_best) = best(columns)
+            if area_best <= 0.0:
+                break
+            shapes[j_best] = shapes[j_best].difference(
+                results[i_best].shape)
+            ops['difference'] += 1
+            shape_areas[j_best] = shapes[j_best].area
+            select(i_best)
+            if engine == 'lazy':
+                versions[j_best] += 1
+                prepared_shapes[j_best] = shapely.prepared.prep(shapes[j_best])
+                ops['prepare'] += 1
+            else:
+                for areas in columns:
+                    areas.pop(i_best, None)
+                columns[j_best] = column(shapes[j_best])
+
+        # Backstop
+        if engine == 'lazy':
+            heap = None
+            versions = [0]
+        while (not_backstopped() and backstop_bool) and (not enough_selected()) and (len(available) > 0):
+            if engine == 'lazy':
+                if heap is None:
+                    heap = lazy_heap([column(backstop_geom)])
+                prepared_backstop = shapely.prepared.prep(backstop_geom)
+                (i_best, _, area_best) = lazy_best(
+                    heap, lambda i, j: evaluate(i, backstop_geom, prepared_backstop), versions)
+                area_best = worth(i_best, area_best)
+            else:
+                (i_best, _, area_best) = best([column(backstop_geom)])
+            if area_best <= 0.0:
+                break
+            backstop_geom = backstop_geom.difference(results[i_best].shape)
+            ops['difference'] += 1
+            backstop_area[0] = backstop_geom.area
+            backstops.add(i_best)
+            select(i_best)
+            if engine == 'lazy':
+                versions[0] += 1
+
+    print('geometry operations: {}'.format(dict(ops)))
     print(len(selections))
-    for selection in selections:
-        del selection['dataShape']
+
+    def selection(i):
+        result = results[i].to_result()
+        if i in backstops:
+            result['backstop'] = True
+        if i in costs:
+            result['cost'] = costs[i]
+        return result
+
     selections = {
         'bounds': shape.bounds,
-        'selections': selections
+        'grid': target_grid(shape.bounds),
+        'selections': list(map(selection, selections))
     }
+    if cost is not None:
+        print('cost: {}'.format(spent[0]))
+        selections['cost'] = spent[0]
 
     return selections, not_backstopped(), not_covered()
 
 
+# Write the selections to the given file, or to a .ERROR file beside
+# it if the AOI could not be covered
+def write_selections(selections, not_backstopped, not_covered, output,
+                     backstop_bool=True, coverage_count=3):
+    if (not backstop_bool or not not_backstopped) and (not not_covered):
+        with open(output, 'w') as f:
+            json.dump(selections, f, sort_keys=True,
+                      indent=4, separators=(',', ': '))
+    else:
+        print('ERROR: not covered')
+        with open(output + '.ERROR', 'w') as f:
+            if coverage_count == 0:
+                selections['selections'] = selections['selections'][0:1]
+            json.dump(selections, f, sort_keys=True,
+                      indent=4, separators=(',', ': '))
+
+
 if __name__ == '__main__':
     import argparse
     import ast
-    import json
 
     def cli_parser() -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser()
@@ -152,12 +546,44 @@ if __name__ == '__main__':
         parser.add_argument('--name-regexp', required=False, type=str)
         parser.add_argument('--minclouds', default=0.0, type=float)
         parser.add_argument('--max-uncovered', default=5e-4, type=float)
+        parser.add_argument('--engine', required=False,
+                            choices=['exhaustive', 'lazy', 'raster'], default='exhaustive')
+        parser.add_argument('--raster-resolution', required=False,
+                            default=0.01, type=float)
+        parser.add_argument('--cost', required=False, type=float,
+                            help='The cost of gathering one scene (e.g. bytes or job-seconds); enables the cost model')
+        parser.add_argument('--tile-discount', required=False,
+                            default=0.0, type=float)
+        parser.add_argument('--date-discount', required=False,
+                            default=0.0, type=float)
+        parser.add_argument('--budget', required=False, type=float)
+        parser.add_argument('--min-gain', required=False,
+                            default=0.0, type=float)
+        parser.add_argument('--tolerance-report', required=False,
+                            default=False, type=ast.literal_eval)
         return parser
 
     args = cli_parser().parse_args()
 
-    with open(args.input, 'r') as f:
-        response = json.load(f)
+    (response, scenes) = read_response(args.input)
+    response['results'] = scenes
+
+    if args.tolerance_report:
+        report = tolerance_report(
+            response,
+            engine='lazy' if args.engine == 'raster' else args.engine,
+            raster_resolution=args.raster_resolution,
+            name_regexp=args.name_regexp,
+            date_regexp=args.date_regexp,
+            minclouds=args.minclouds,
+            max_uncovered=args.max_uncovered,
+            max_selections=args.max_selections,
+            coverage_count=args.coverage_count,
+            backstop_bool=args.backstop
+        )
+        with open(args.output + '.tolerance.json', 'w') as f:
+            json.dump(report, f, sort_keys=True,
+                      indent=4, separators=(',', ': '))
 
     selections, not_backstopped, not_covered = filter_response(
         response,
@@ -167,18 +593,17 @@ if __name__ == '__main__':
         max_uncovered=args.max_uncovered,
         max_selections=args.max_selections,
         coverage_count=args.coverage_count,
-        backstop_bool=args.backstop
+        backstop_bool=args.backstop,
+        engine=args.engine,
+        raster_resolution=args.raster_resolution,
+        cost=args.cost,
+        tile_discount=args.tile_discount,
+        date_discount=args.date_discount,
+        budget=args.budget,
+        min_gain=args.min_gain
     )
 
     # Render results
-    if (not args.backstop or not not_backstopped) and (not not_covered):
-        with open(args.output, 'w') as f:
-            json.dump(selections, f, sort_keys=True,
-                      indent=4, separators=(',', ': '))
-    else:
-        print('ERROR: not covered')
-        with open(args.output + '.ERROR', 'w') as f:
-            if args.coverage_count == 0:
-                selections['selections'] = selections['selections'][0:1]
-            json.dump(selections, f, sort_keys=True,
-                      indent=4, separators=(',', ': '))
+    write_selections(selections, not_backstopped, not_covered, args.output,
+                     backstop_bool=args.backstop,
+                     coverage_count=args.coverage_count)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import concurrent.futures
+import json
+import os
+from typing import Dict, List, Optional
+
+import shapely.geometry  # type: ignore
+import shapely.ops  # type: ignore
+import shapely.strtree  # type: ignore
+
+try:
+    from .filter import filter_response, strtree_query, write_selections
+    from .scenes import Scene, read_response
+except ImportError:
+    from filter import filter_response, strtree_query, write_selections  # type: ignore
+    from scenes import Scene, read_response  # type: ignore
+
+# The pool of candidates, set once in each worker process
+POOL: List[Scene] = []
+
+
+def set_pool(pool: List[Scene]) -> None:
+    global POOL
+    POOL = pool
+
+
+# Combine the results of several query response files into one pool of
+# candidates, dropping scenes that appear more than once, and build the
+# footprint of each candidate once
+def candidate_pool(filenames: List[str]) -> List[Scene]:
+    pool = []
+    names = set()
+    for filename in filenames:
+        (_, scenes) = read_response(filename)
+        for scene in scenes:
+            if scene.name in names:
+                continue
+            names.add(scene.name)
+            scene.shape  # built here, once, and shared with the workers
+            pool.append(scene)
+    return pool
+
+
+# The AOIs in the given GeoJSON files, keyed by name.  Each file is one
+# AOI named after the file, unless a name property is given, in which
+# case each feature is an AOI named by that property.
+def read_aois(filenames: List[str], name_property: Optional[str] = None) -> Dict[str, dict]:
+    aois = {}
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            features = json.load(f)
+        if 'features' not in features:
+            features = {'features': [features]}
+        if name_property is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            shape = shapely.ops.unary_union(list(map(
+                lambda f: shapely.geometry.shape(f.get('geometry')),
+                features.get('features'))))
+            aois[name] = shapely.geometry.mapping(shape)
+        else:
+            for feature in features.get('features'):
+                name = feature.get('properties').get(name_property)
+                aois[name] = feature.get('geometry')
+    return aois
+
+
+# Filter the candidates with the given indices for one AOI
+def filter_aoi(name: str, aoi: dict, indices: List[int], kwargs: dict):
+    response = {
+        'aoi': aoi,
+        'results': list(map(lambda i: POOL[i], indices))
+    }
+    return (name,) + filter_response(response, **kwargs)
+
+
+# Run filter_response for each of the given AOIs against one pool of
+# candidates in a pool of worker processes.  Only candidates whose
+# envelopes meet an AOI are sent with it; the others would never be
+# selected.  Returns (selections, not_backstopped, not_covered) keyed
+# by AOI name.
+def filter_batch(aois: Dict[str, dict],
+                 pool: List[Scene],
+                 workers: Optional[int] = None,
+                 **kwargs) -> Dict[str, tuple]:
+    tree = shapely.strtree.STRtree(list(map(lambda r: r.shape, pool)))
+    outputs = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=set_pool,
+                                                initargs=(pool,)) as executor:
+        futures = []
+        for (name, aoi) in aois.items():
+            shape = shapely.geometry.shape(aoi)
+            indices = sorted(map(int, strtree_query(tree, shape)))
+            futures.append(executor.submit(filter_aoi, name, aoi, indices, kwargs))
+        for future in concurrent.futures.as_completed(futures):
+            (name, selections, not_backstopped, not_covered) = future.result()
+            outputs[name] = (selections, not_backstopped, not_covered)
+
+    return outputs
+
+
+if __name__ == '__main__':
+    import argparse
+    import ast
+
+    def cli_parser() -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--aois', required=True, nargs='+', type=str,
+                            help='GeoJSON files containing the AOIs')
+        parser.add_argument('--name-property', required=False, type=str,
+                            help='The property used to name each feature as its own AOI')
+        parser.add_argument('--input', required=True, nargs='+', type=str,
+                            help='Query responses combined into one pool of candidates')
+        parser.add_argument('--output-dir', required=False, default='.', type=str)
+        parser.add_argument('--workers', required=False, type=int)
+        parser.add_argument('--backstop', required=False,
+                            default=True, type=ast.literal_eval)
+        parser.add_argument('--coverage-count',
+                            required=False, default=3, type=int)
+        parser.add_argument('--max-selections', required=False, type=int)
+        parser.add_argument('--date-regexp', required=False, type=str)
+        parser.add_argument('--name-regexp', required=False, type=str)
+        parser.add_argument('--minclouds', default=0.0, type=float)
+        parser.add_argument('--max-uncovered', default=5e-4, type=float)
+        parser.add_argument('--engine', required=False,
+                            choices=['exhaustive', 'lazy', 'raster'], default='exhaustive')
+        parser.add_argument('--raster-resolution', required=False,
+                            default=0.01, type=float)
+        parser.add_argument('--cost', required=False, type=float,
+                            help='The cost of gathering one scene (e.g. bytes or job-seconds); enables the cost model')
+        parser.add_argument('--tile-discount', required=False,
+                            default=0.0, type=float)
+        parser.add_argument('--date-discount', required=False,
+                            default=0.0, type=float)
+        parser.add_argument('--budget', required=False, type=float)
+        parser.add_argument('--min-gain', required=False,
+                            default=0.0, type=float)
+        return parser
+
+    args = cli_parser().parse_args()
+
+    pool = candidate_pool(args.input)
+    aois = read_aois(args.aois, args.name_property)
+    print('{} candidates, {} AOIs'.format(len(pool), len(aois)))
+
+    outputs = filter_batch(
+        aois,
+        pool,
+        workers=args.workers,
+        name_regexp=args.name_regexp,
+        date_regexp=args.date_regexp,
+        minclouds=args.minclouds,
+        max_uncovered=args.max_uncovered,
+        max_selections=args.max_selections,
+        coverage_count=args.coverage_count,
+        backstop_bool=args.backstop,
+        engine=args.engine,
+        raster_resolution=args.raster_resolution,
+        cost=args.cost,
+        tile_discount=args.tile_discount,
+        date_discount=args.date_discount,
+        budget=args.budget,
+        min_gain=args.min_gain
+    )
+
+    # Render results
+    for (name, (selections, not_backstopped, not_covered)) in sorted(outputs.items()):
+        output = os.path.join(args.output_dir, '{}.json'.format(name))
+        write_selections(selections, not_backstopped, not_covered, output,
+                         backstop_bool=args.backstop,
+                         coverage_count=args.coverage_count)
+        print(output)
@@ -31,6 +31,7 @@ import copy
 import json
 import math
 import os
+import time
 from urllib.parse import urlparse
 from typing import Optional, List
 
@@ -45,6 +46,15 @@ import scipy.ndimage
 import torch
 import torchvision
 
+try:
+    from .sizing import record_metrics, usage
+except ImportError:
+    from sizing import record_metrics, usage  # type: ignore
+
+# Models loaded by earlier gathers in this process (e.g. those of a
+# packed job), by architecture, weights, bands and device
+MODELS: dict = {}
+
 
 def read_text(uri: str) -> str:
     parsed = urlparse(uri)
@@ -68,6 +78,15 @@ def load_architecture(uri: str) -> None:
     exec(arch_code, globals())
 
 
+# When this process started (on Linux, when its entry in /proc was
+# made), so that gathers can record how long it took to get to them
+def process_started() -> float:
+    try:
+        return os.stat('/proc/self').st_ctime
+    except OSError:
+        return time.time()
+
+
 def gather(sentinel_path: str,
            output_s3_uri: str,
            index: int,
@@ -82,7 +101,15 @@ def gather(sentinel_path: str,
            kind: str = 'L1C',
            donate_mask: bool = False,
            donor_mask: Optional[str] = None,
-           donor_mask_name: Optional[str] = None):
+           donor_mask_name: Optional[str] = None,
+           cog: bool = False,
+           grid: Optional[List[float]] = None,
+           metrics: Optional[str] = None,
+           pack: int = 1,
+           position: int = 0,
+           started: Optional[float] = None):
+    start = usage()
+    model_seconds = 0.0
     codes = []
 
     s2cloudless = False
@@ -90,6 +117,7 @@ def gather(sentinel_path: str,
     assert output_s3_uri.endswith('/')
     assert not working_dir.endswith('/')
     assert (len(bounds) == 4 if bounds is not None else True)
+    assert (len(grid) == 4 if grid is not None else True)
     assert (weights.endswith('.pth') if weights is not None else True)
     assert (kind in ['L1C', 'L2A'])
     if donor_mask is not None:
@@ -251,19 +279,24 @@ def gather(sentinel_path: str,
     # Get model cloud mask
     if not backstop and architecture is not None and weights is not None and donor_mask is None:
         model_window_size = 512
-        load_architecture(architecture)
+        model_start = time.time()
         if torch.cuda.is_available():
             device = torch.device('cuda')
         else:
             device = torch.device('cpu')
-        if not os.path.exists(working('weights.pth')):
-            os.system('aws s3 cp {} {}'.format(
-                weights, working('weights.pth')))
-        model = make_model(num_bands-1, input_stride=1,
-                           class_count=1, divisor=1, pretrained=False).to(device)
-        model.load_state_dict(torch.load(
-            working('weights.pth'), map_location=device))
-        model = model.eval()
+        key = (architecture, weights, num_bands, str(device))
+        if key not in MODELS:
+            load_architecture(architecture)
+            if not os.path.exists(working('weights.pth')):
+                os.system('aws s3 cp {} {}'.format(
+                    weights, working('weights.pth')))
+            model = make_model(num_bands-1, input_stride=1,
+                               class_count=1, divisor=1, pretrained=False).to(device)
+            model.load_state_dict(torch.load(
+                working('weights.pth'), map_location=device))
+            MODELS[key] = model.eval()
+        model = MODELS.get(key)
+        model_seconds = time.time() - model_start
 
         with torch.no_grad():
             tmp = np.zeros((1, width, height), dtype=np.float32)
@@ -326,12 +359,30 @@ def gather(sentinel_path: str,
     with rio.open(working('scratch.tif'), 'w', **profile) as ds:
         ds.write(data)
 
-    # Warp and compress to create final file
+    # Warp and compress to create final file.  If a grid is given, the
+    # output is snapped to it so that it can be merged without
+    # resampling.
     if bounds is None or len(bounds) != 4:
         te = ''
     else:
         [xmin, ymin, xmax, ymax] = bounds
         te = '-te {} {} {} {}'.format(xmin, ymin, xmax, ymax)
+    if grid is not None:
+        [xorigin, yorigin, xres, yres] = grid
+        if te == '':
+            te = '-tap'
+        else:
+            xmin = xorigin + math.floor((xmin - xorigin) / xres) * xres
+            xmax = xorigin + math.ceil((xmax - xorigin) / xres) * xres
+            ymin = yorigin - math.ceil((yorigin - ymin) / yres) * yres
+            ymax = yorigin - math.floor((yorigin - ymax) / yres) * yres
+            te = '-te {} {} {} {}'.format(xmin, ymin, xmax, ymax)
+        yres = -yres
+    if cog:
+        # gdalwarp computes the overviews as it writes the COG
+        co = '-of COG -co OVERVIEW_RESAMPLING=NEAREST -co BIGTIFF=YES -co COMPRESS=DEFLATE -co PREDICTOR=2 '
+    else:
+        co = '-co BIGTIFF=YES -co COMPRESS=DEFLATE -co PREDICTOR=2 -co TILED=YES -co SPARSE_OK=YES '
     command = ''.join([
         'gdalwarp {} '.format(working('scratch.tif')),
         '-tr {} {} '.format(xres, yres),
@@ -340,7 +391,7 @@ def gather(sentinel_path: str,
         '-multi ',
         '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
         '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-        '-co BIGTIFF=YES -co COMPRESS=DEFLATE -co PREDICTOR=2 -co TILED=YES -co SPARSE_OK=YES ',
+        co,
         '{} '.format(te),
         '{}'.format(filename)
     ])
@@ -353,6 +404,25 @@ def gather(sentinel_path: str,
     code = os.system('aws s3 cp {} {}'.format(filename, output_s3_uri))
     codes.append(code)
 
+    if metrics is not None:
+        with rio.open(filename, 'r') as ds:
+            window_pixels = ds.width * ds.height
+        inference = not backstop and architecture is not None and weights is not None and donor_mask is None
+        record = {
+            'job': 'gather',
+            'kind': kind,
+            'inference': inference,
+            'window_pixels': window_pixels,
+            'pack': pack,
+            'position': position,
+            'model_seconds': model_seconds,
+        }
+        # The time between the start of the process and the first
+        # gather in it is overhead that packing spreads out
+        if started is not None and position == 0:
+            record['startup_seconds'] = start[0] - started
+        record_metrics(metrics, working('{}-gather.json'.format(name_pattern)), start, record)
+
     codes = list(map(lambda c: os.WEXITSTATUS(c) != 0, codes))
     return codes
 
@@ -364,14 +434,14 @@ if __name__ == '__main__':
 
     def cli_parser() -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser()
-        parser.add_argument('--backstop', required=True, type=ast.literal_eval)
+        parser.add_argument('--backstop', required=False, type=ast.literal_eval)
         parser.add_argument('--bounds', required=False, nargs='+', type=float)
         parser.add_argument('--delete', required=False,
                             default=True, type=ast.literal_eval)
-        parser.add_argument('--index', required=True, type=int)
+        parser.add_argument('--index', required=False, type=int)
         parser.add_argument('--name', required=True, type=str)
         parser.add_argument('--output-path', required=True, type=str)
-        parser.add_argument('--sentinel-path', required=True, type=str)
+        parser.add_argument('--sentinel-path', required=False, type=str)
         parser.add_argument('--architecture', required=False, type=str)
         parser.add_argument('--weights', required=False, type=str)
         parser.set_defaults(s2cloudless=False)
@@ -384,32 +454,79 @@ if __name__ == '__main__':
         parser.add_argument('--donor-mask-name', required=False,
                             default=None, type=str)
         parser.add_argument('--tmp', required=False, type=str, default='/tmp')
+        parser.add_argument('--cog', required=False,
+                            default=False, type=ast.literal_eval)
+        parser.add_argument('--grid', required=False, nargs=4, type=float,
+                            help='The origin and resolution of the target grid')
+        parser.add_argument('--metrics', required=False, type=str,
+                            help='Where to record the resources that the gather used')
+        parser.add_argument('--manifest', required=False, type=str,
+                            help='A manifest from which children of an array job take --backstop, --index and --sentinel-path (and possibly --bounds and --grid) of each selection in their pack')
         return parser
 
-    args = cli_parser().parse_args()
+    parser = cli_parser()
+    args = parser.parse_args()
+
+    # Children of an array job find their selections in the manifest:
+    # the `pack` consecutive entries at their array index, which they
+    # gather one after another
+    selections = []
+    if args.manifest is not None:
+        manifest = json.loads(read_text(args.manifest))
+        pack = manifest.get('pack', 1)
+        i = int(os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX', 0))
+        for entry in manifest.get('entries')[(i*pack):((i+1)*pack)]:
+            selections.append({
+                'backstop': entry.get('backstop'),
+                'index': entry.get('index'),
+                'sentinel_path': entry.get('sentinel_path'),
+                'bounds': entry.get('bounds', args.bounds),
+                'grid': entry.get('grid', args.grid),
+            })
+    elif None in [args.backstop, args.index, args.sentinel_path]:
+        parser.error('--backstop, --index and --sentinel-path are required without --manifest')
+    else:
+        selections.append({
+            'backstop': args.backstop,
+            'index': args.index,
+            'sentinel_path': args.sentinel_path,
+            'bounds': args.bounds,
+            'grid': args.grid,
+        })
 
     if args.donor_mask == 'None':
         args.donor_mask = None
     if args.donor_mask_name == 'None':
         args.donor_mask_name = None
 
-    codes = gather(
-        args.sentinel_path,
-        args.output_path,
-        args.index,
-        args.name,
-        args.backstop,
-        working_dir=args.tmp,
-        delete=args.delete,
-        architecture=args.architecture,
-        weights=args.weights,
-        bounds=args.bounds,
-        s2cloudless=args.s2cloudless,
-        kind=args.kind,
-        donate_mask=args.donate_mask,
-        donor_mask=args.donor_mask,
-        donor_mask_name=args.donor_mask_name
-    )
+    # The bands of one selection must not be mistaken for those of the
+    # next, so packed gathers always clean up after themselves
+    started = process_started()
+    codes = []
+    for (position, selection) in enumerate(selections):
+        codes += gather(
+            selection.get('sentinel_path'),
+            args.output_path,
+            selection.get('index'),
+            args.name,
+            selection.get('backstop'),
+            working_dir=args.tmp,
+            delete=args.delete or len(selections) > 1,
+            architecture=args.architecture,
+            weights=args.weights,
+            bounds=selection.get('bounds'),
+            s2cloudless=args.s2cloudless,
+            kind=args.kind,
+            donate_mask=args.donate_mask,
+            donor_mask=args.donor_mask,
+            donor_mask_name=args.donor_mask_name,
+            cog=args.cog,
+            grid=selection.get('grid'),
+            metrics=args.metrics,
+            pack=len(selections),
+            position=position,
+            started=started
+        )
 
     if any(codes):
         sys.exit(-1)
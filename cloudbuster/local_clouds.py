@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import concurrent.futures
+import math
+from typing import Optional
+
+import numpy as np
+import rasterio as rio
+import rasterio.enums
+import rasterio.features
+import rasterio.warp
+import rasterio.windows
+import shapely.geometry  # type: ignore
+
+try:
+    from .scenes import Scene, read_response, write_response
+except ImportError:
+    from scenes import Scene, read_response, write_response  # type: ignore
+
+SOURCE = 's3://sentinel-s2-l2a'
+
+
+def vsi_uri(uri: str) -> str:
+    if uri.startswith('s3://'):
+        return '/vsis3/' + uri[5:]
+    return uri
+
+
+# The percentage of the part of the AOI covered by a scene that the
+# scene's cloud probability mask (qi/CLD_20m.jp2) marks as cloudy, or
+# None if the scene does not cover the AOI or the mask can not be read.
+# Only the window of the mask that contains the AOI is read, and it is
+# read at the given (coarser) resolution so that only the overview
+# levels of the JPEG 2000 file that are needed are fetched.
+def aoi_cloud_percentage(aoi, footprint, path: str,
+                         source: str = SOURCE,
+                         threshold: int = 40,
+                         resolution: float = 60.0) -> Optional[float]:
+    region = aoi.intersection(footprint)
+    if region.is_empty:
+        return None
+
+    uri = vsi_uri('{}/{}/qi/CLD_20m.jp2'.format(source, path))
+    try:
+        with rio.open(uri) as ds:
+            geometry = rasterio.warp.transform_geom(
+                'EPSG:4326', ds.crs, shapely.geometry.mapping(region))
+            (xmin, ymin, xmax, ymax) = shapely.geometry.shape(geometry).bounds
+            window = rasterio.windows.from_bounds(xmin, ymin, xmax, ymax, ds.transform)
+            col0 = int(math.floor(window.col_off))
+            row0 = int(math.floor(window.row_off))
+            col1 = int(math.ceil(window.col_off + window.width))
+            row1 = int(math.ceil(window.row_off + window.height))
+            window = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0).intersection(
+                rasterio.windows.Window(0, 0, ds.width, ds.height))
+            factor = max(1.0, resolution / ds.res[0])
+            out_shape = (max(1, int(math.ceil(window.height / factor))),
+                         max(1, int(math.ceil(window.width / factor))))
+            cld = ds.read(1, window=window, out_shape=out_shape,
+                          resampling=rasterio.enums.Resampling.nearest)
+            transform = ds.window_transform(window) * rio.Affine.scale(
+                window.width / out_shape[1], window.height / out_shape[0])
+    except (rio.errors.RasterioIOError, rio.errors.WindowError):
+        return None
+
+    inside = rasterio.features.geometry_mask(
+        [geometry], out_shape=out_shape, transform=transform,
+        all_touched=True, invert=True)
+    pixels = int(inside.sum())
+    if pixels == 0:
+        return None
+    cloudy = int(((cld > threshold) & inside).sum())
+    return 100.0 * cloudy / pixels
+
+
+# Annotate each result in a query response with the cloud percentage
+# over the response's AOI (sceneMetadata.aoiCloudyPixelPercentage),
+# which filter_response prefers to the scene-wide percentage.  The
+# results are returned as Scenes.  The reads are I/O bound, so they
+# are done on a pool of threads.
+def local_clouds(response: dict,
+                 source: str = SOURCE,
+                 threshold: int = 40,
+                 resolution: float = 60.0,
+                 workers: int = 16) -> dict:
+    aoi = shapely.geometry.shape(response.get('aoi'))
+    results = list(map(lambda r: r if isinstance(r, Scene) else Scene.from_result(r),
+                       response.get('results')))
+
+    def estimate(scene):
+        return aoi_cloud_percentage(aoi, scene.shape, scene.path,
+                                    source=source,
+                                    threshold=threshold,
+                                    resolution=resolution)
+
+    with rio.Env(AWS_REQUEST_PAYER='requester',
+                 GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+                 CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.jp2'):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            percentages = list(executor.map(estimate, results))
+
+    for (scene, percentage) in zip(results, percentages):
+        if percentage is not None:
+            scene.aoi_cloudy = percentage
+    response['results'] = results
+    print('{} of {} scenes estimated'.format(
+        len(list(filter(lambda p: p is not None, percentages))), len(results)))
+
+    return response
+
+
+if __name__ == '__main__':
+    import argparse
+
+    def cli_parser() -> argparse.ArgumentParser:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--input', required=True, type=str)
+        parser.add_argument('--output', required=True, type=str)
+        parser.add_argument('--source', required=False, default=SOURCE, type=str,
+                            help='Where the Sentinel-2 L2A tiles are found')
+        parser.add_argument('--threshold', required=False, default=40, type=int,
+                            help='Cloud probabilities above this are cloudy')
+        parser.add_argument('--resolution', required=False, default=60.0, type=float,
+                            help='The resolution (in meters) at which the masks are read')
+        parser.add_argument('--workers', required=False, default=16, type=int)
+        return parser
+
+    args = cli_parser().parse_args()
+
+    (response, scenes) = read_response(args.input)
+    response['results'] = scenes
+
+    response = local_clouds(response,
+                            source=args.source,
+                            threshold=args.threshold,
+                            resolution=args.resolution,
+                            workers=args.workers)
+
+    scenes = response.pop('results')
+    write_response(args.output, response, scenes)
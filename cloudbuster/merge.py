@@ -28,134 +28,737 @@
 
 import copy
 import json
+import math
 import os
 import sys
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
 
 import numpy as np
 
 import rasterio as rio
+import rasterio.crs
+import rasterio.enums
+import rasterio.shutil
+import rasterio.transform
+import rasterio.windows
 import scipy.ndimage
 
+try:
+    from .sizing import copy_uri, record_metrics, usage
+except ImportError:
+    from sizing import copy_uri, record_metrics, usage  # type: ignore
+
+BLOCK_SIZE = 512
+EPSILON = 1e-6
+
+
+# Divide a bounding box into a near-square grid of shards, returned in
+# row-major order starting from the upper-left corner of the box.
+def shard_bounds(bounds: List[float], shards: int) -> List[List[float]]:
+    assert len(bounds) == 4
+    assert shards > 0
+    [xmin, ymin, xmax, ymax] = bounds
+    width = xmax - xmin
+    height = ymax - ymin
+
+    # Choose the factorization of shards that gives the most square cells
+    best = None
+    for cols in range(1, shards + 1):
+        if shards % cols != 0:
+            continue
+        rows = shards // cols
+        badness = abs(math.log((width / cols) / (height / rows)))
+        if best is None or badness < best[0]:
+            best = (badness, cols, rows)
+    [_, cols, rows] = best
+
+    retval = []
+    for row in range(rows):
+        for col in range(cols):
+            retval.append([
+                xmin + (width * col) / cols,
+                ymax - (height * (row + 1)) / rows,
+                xmin + (width * (col + 1)) / cols,
+                ymax - (height * row) / rows,
+            ])
+    return retval
+
+
+def shard_name(name: str, shard: int) -> str:
+    return '{}-shard-{:02d}'.format(name, shard)
+
+
+# Remove a file from S3 or a local directory
+def remove_uri(uri: str) -> int:
+    if uri.startswith('s3://'):
+        return os.system('aws s3 rm {}'.format(uri))
+    if not os.path.isfile(uri):
+        return 1
+    os.remove(uri)
+    return 0
+
+
+# The GDAL path of a file under an S3 prefix or a local directory
+def vsi_uri(uri: str) -> str:
+    if uri.startswith('s3://'):
+        return uri.replace('s3://', '/vsis3/', 1)
+    return uri
+
+
+# Returns a dictionary mapping the name of each object directly under
+# an S3 prefix (or in a local directory) to its checksum.  For local
+# files the size and modification time serve as the checksum.
+def list_objects(uri: str) -> Dict[str, str]:
+    objects = {}
+    if uri.startswith('s3://'):
+        parsed = uri[len('s3://'):].split('/', 1)
+        [bucket, prefix] = parsed if len(parsed) == 2 else [parsed[0], '']
+        listing = json.loads(os.popen(''.join([
+            'aws s3api list-objects-v2 ',
+            '--bucket {} --prefix "{}" '.format(bucket, prefix),
+            '--query "Contents[].[Key,ETag]" --output json'
+        ])).read() or 'null') or []
+        for [key, etag] in listing:
+            filename = key[len(prefix):]
+            if '/' not in filename:
+                objects[filename] = etag.strip('"')
+    elif os.path.isdir(uri):
+        for filename in os.listdir(uri):
+            stat = os.stat(os.path.join(uri, filename))
+            if os.path.isfile(os.path.join(uri, filename)):
+                objects[filename] = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+    return objects
+
+
+# Returns a dictionary mapping the name of each gathered image under
+# input_s3_uri to its checksum.  Masks and the products of previous
+# merges are not sources.
+def list_sources(input_s3_uri: str) -> Dict[str, str]:
+    sources = {}
+    for (filename, etag) in list_objects(input_s3_uri).items():
+        if not filename.endswith('.tif'):
+            continue
+        if filename.startswith('mask') or 'cloudy' in filename or 'cloudless' in filename:
+            continue
+        sources[filename] = etag
+    return sources
+
+
+def source_info(filename: str) -> dict:
+    with rio.open(filename, 'r') as ds:
+        return {
+            'bounds': list(ds.bounds),
+            'res': [abs(ds.res[0]), abs(ds.res[1])],
+            'count': ds.count,
+            'crs': ds.crs.to_string(),
+        }
+
+
+# Compute the grid of the output image from the source images.  When
+# bounds are given, the resolution is pinned to the finest input
+# resolution and pixels are aligned to it so that neighboring shards
+# land on the same grid.
+def output_grid(infos: Dict[str, dict], bounds: Optional[List[float]] = None) -> dict:
+    xres = min(map(lambda i: i.get('res')[0], infos.values()))
+    yres = min(map(lambda i: i.get('res')[1], infos.values()))
+    if bounds is None:
+        xmin = min(map(lambda i: i.get('bounds')[0], infos.values()))
+        ymin = min(map(lambda i: i.get('bounds')[1], infos.values()))
+        xmax = max(map(lambda i: i.get('bounds')[2], infos.values()))
+        ymax = max(map(lambda i: i.get('bounds')[3], infos.values()))
+    else:
+        [xmin, ymin, xmax, ymax] = bounds
+        xmin = math.floor(xmin / xres + EPSILON) * xres
+        ymin = math.floor(ymin / yres + EPSILON) * yres
+        xmax = math.ceil(xmax / xres - EPSILON) * xres
+        ymax = math.ceil(ymax / yres - EPSILON) * yres
+    return {
+        'crs': next(iter(infos.values())).get('crs'),
+        'transform': list(rasterio.transform.from_origin(xmin, ymax, xres, yres))[0:6],
+        'width': max(1, int(round((xmax - xmin) / xres))),
+        'height': max(1, int(round((ymax - ymin) / yres))),
+        'count': max(map(lambda i: i.get('count'), infos.values())),
+    }
+
+
+def grid_tiles(grid: dict):
+    for row in range(0, grid.get('height'), BLOCK_SIZE):
+        for col in range(0, grid.get('width'), BLOCK_SIZE):
+            yield rasterio.windows.Window(
+                col, row,
+                min(BLOCK_SIZE, grid.get('width') - col),
+                min(BLOCK_SIZE, grid.get('height') - row))
+
+
+def tile_key(window) -> str:
+    return '{}/{}'.format(window.row_off // BLOCK_SIZE, window.col_off // BLOCK_SIZE)
+
+
+def intersects(bounds1: List[float], bounds2: List[float]) -> bool:
+    return (bounds1[0] < bounds2[2] and bounds2[0] < bounds1[2] and
+            bounds1[1] < bounds2[3] and bounds2[1] < bounds1[3])
+
+
+# If a source image lies on the output grid, returns the offset (in
+# pixels) of its upper-left corner in the output, otherwise None.
+def aligned_offset(ds, grid: dict) -> Optional[List[int]]:
+    transform = rasterio.Affine(*grid.get('transform'))
+    if ds.transform.b != 0 or ds.transform.d != 0:
+        return None
+    if abs(ds.transform.a - transform.a) > EPSILON * transform.a:
+        return None
+    if abs(ds.transform.e - transform.e) > EPSILON * -transform.e:
+        return None
+    col = (ds.transform.c - transform.c) / transform.a
+    row = (ds.transform.f - transform.f) / transform.e
+    if abs(col - round(col)) > EPSILON or abs(row - round(row)) > EPSILON:
+        return None
+    return [int(round(col)), int(round(row))]
+
+
+# Fill the empty pixels of a tile of the output from a source image.
+# A pixel is empty if it is zero in every band.  Sources on the output
+# grid are copied block-for-block; others are resampled.  Returns True
+# if the tile has no remaining empty pixels.
+def fill_tile(ds, grid: dict, window, tile: np.ndarray) -> bool:
+    offset = aligned_offset(ds, grid)
+    if offset is not None:
+        [col, row] = offset
+        col_off = max(window.col_off, col)
+        row_off = max(window.row_off, row)
+        width = min(window.col_off + window.width, col + ds.width) - col_off
+        height = min(window.row_off + window.height, row + ds.height) - row_off
+        if width <= 0 or height <= 0:
+            return False
+        data = ds.read(window=rasterio.windows.Window(
+            col_off - col, row_off - row, width, height))
+        col_off = col_off - window.col_off
+        row_off = row_off - window.row_off
+    else:
+        transform = rasterio.Affine(*grid.get('transform'))
+        [left, bottom, right, top] = rasterio.windows.bounds(window, transform)
+        [left, bottom, right, top] = [
+            max(left, ds.bounds.left), max(bottom, ds.bounds.bottom),
+            min(right, ds.bounds.right), min(top, ds.bounds.top)]
+        [xres, yres] = [transform.a, -transform.e]
+        col_off = int(round((left - transform.c) / xres)) - window.col_off
+        row_off = int(round((transform.f - top) / yres)) - window.row_off
+        width = int(round((right - left) / xres))
+        height = int(round((top - bottom) / yres))
+        if width <= 0 or height <= 0:
+            return False
+        data = ds.read(window=rasterio.windows.from_bounds(left, bottom, right, top, ds.transform),
+                       out_shape=(ds.count, height, width),
+                       resampling=rasterio.enums.Resampling.nearest)
+
+    dst = tile[0:ds.count, row_off:(row_off+height), col_off:(col_off+width)]
+    empty = ~(dst.any(axis=0))
+    dst[:, empty] = data[:, empty]
+    return bool(tile.any(axis=0).all())
+
+
+# Overviews are decimated by successive powers of two until the
+# smallest one fits in a single block.  Factors never exceed the block
+# size so that each tile maps onto a whole number of overview pixels.
+def overview_factors(width: int, height: int) -> List[int]:
+    factors = []
+    factor = 2
+    while factor <= BLOCK_SIZE and max(width, height) > BLOCK_SIZE * (factor // 2):
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def decimate_window(window, factor: int):
+    return rasterio.windows.Window(
+        window.col_off // factor, window.row_off // factor,
+        (window.width + factor - 1) // factor, (window.height + factor - 1) // factor)
+
+
+# Open one scratch image per overview level of a product
+def open_levels(filename: str, profile: dict, factors: List[int]) -> list:
+    levels = []
+    for factor in factors:
+        level_profile = copy.deepcopy(profile)
+        level_profile.update(
+            width=(profile.get('width') + factor - 1) // factor,
+            height=(profile.get('height') + factor - 1) // factor,
+            transform=profile.get('transform') * rasterio.Affine.scale(factor))
+        levels.append(rio.open('{}.{}.tif'.format(filename, factor), 'w', **level_profile))
+    return levels
+
+
+# A VRT (inline, for use as the filename of a source in another VRT)
+# that presents a gathered image with a mask taken from its last band.
+# That band holds the index of the image wherever it has data and zero
+# elsewhere, so the mask is valid exactly where fill_tile considers a
+# pixel of the image to be filled (some band is non-zero).
+def masked_source(filename: str, info: dict) -> str:
+    [left, bottom, right, top] = info.get('bounds')
+    [xres, yres] = info.get('res')
+    bands = []
+    for band in range(1, info.get('count') + 1):
+        source = '<SourceFilename relativeToVRT="0">{}</SourceFilename><SourceBand>{}</SourceBand>'.format(
+            filename, band)
+        bands.append('<VRTRasterBand dataType="UInt16" band="{}"><SimpleSource>{}</SimpleSource></VRTRasterBand>'.format(
+            band, source))
+    mask = '<ComplexSource>{}<ScaleRatio>255</ScaleRatio></ComplexSource>'.format(source)
+    return ''.join([
+        '<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(
+            int(round((right - left) / xres)), int(round((top - bottom) / yres))),
+        '<GeoTransform>{}</GeoTransform>'.format(', '.join(map(repr, [left, xres, 0.0, top, 0.0, -yres]))),
+        ''.join(bands),
+        '<MaskBand><VRTRasterBand dataType="Byte">{}</VRTRasterBand></MaskBand>'.format(mask),
+        '</VRTDataset>'
+    ])
+
+
+# Describe a mosaic of images as a VRT on the output grid.  The
+# sources (pairs of filenames and information as returned by
+# source_info) are given in order of decreasing priority.  When there
+# are several, each is drawn through its mask (see masked_source) so
+# that a pixel comes from one source in all bands, as in merge.
+# Overviews, if given, are one image per level from the finest to the
+# coarsest.
+def vrt_xml(grid: dict, sources: List[Tuple[str, dict]], overviews: List[str] = []) -> str:
+    crs = rasterio.crs.CRS.from_string(grid.get('crs'))
+    transform = grid.get('transform')
+    geotransform = [transform[2], transform[0], transform[1],
+                    transform[5], transform[3], transform[4]]
+    tag = 'SimpleSource' if len(sources) == 1 else 'ComplexSource'
+
+    def rect(element, x, y, width, height):
+        return '<{} xOff="{}" yOff="{}" xSize="{}" ySize="{}"/>'.format(
+            element, repr(x), repr(y), repr(width), repr(height))
+
+    bands = []
+    for band in range(1, grid.get('count') + 1):
+        elements = []
+        # Later sources are drawn over earlier ones, so the highest
+        # priority source goes last
+        for (filename, info) in reversed(sources):
+            [left, bottom, right, top] = info.get('bounds')
+            [xres, yres] = info.get('res')
+            if tag == 'ComplexSource':
+                filename = escape(masked_source(filename, info))
+            elements.append(''.join([
+                '<{}>'.format(tag),
+                '<SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(filename),
+                '<SourceBand>{}</SourceBand>'.format(band),
+                rect('SrcRect', 0, 0,
+                     int(round((right - left) / xres)), int(round((top - bottom) / yres))),
+                rect('DstRect',
+                     (left - transform[2]) / transform[0], (top - transform[5]) / transform[4],
+                     (right - left) / transform[0], (top - bottom) / -transform[4]),
+                '<UseMaskBand>true</UseMaskBand>' if tag == 'ComplexSource' else '',
+                '</{}>'.format(tag)
+            ]))
+        for filename in overviews:
+            elements.append(''.join([
+                '<Overview>',
+                '<SourceFilename relativeToVRT="0">{}</SourceFilename>'.format(filename),
+                '<SourceBand>{}</SourceBand>'.format(band),
+                '</Overview>'
+            ]))
+        bands.append(''.join([
+            '<VRTRasterBand dataType="UInt16" band="{}">'.format(band),
+            '<NoDataValue>0</NoDataValue>',
+            ''.join(elements),
+            '</VRTRasterBand>'
+        ]))
+
+    return ''.join([
+        '<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(
+            grid.get('width'), grid.get('height')),
+        '<SRS>{}</SRS>'.format(crs.to_wkt().replace('"', '&quot;')),
+        '<GeoTransform>{}</GeoTransform>'.format(', '.join(map(repr, geotransform))),
+        ''.join(bands),
+        '</VRTDataset>'
+    ])
+
+
+# Combine a full-resolution image and its (already computed) overview
+# images into a Cloud-Optimized GeoTIFF.  The overviews are copied, not
+# recomputed.
+def write_cog(filename: str, factors: List[int], cog_filename: str):
+    with rio.open(filename, 'r') as ds:
+        grid = {
+            'crs': ds.crs.to_string(),
+            'transform': list(ds.transform)[0:6],
+            'width': ds.width,
+            'height': ds.height,
+            'count': ds.count,
+        }
+    overviews = list(map(lambda f: '{}.{}.tif'.format(filename, f), factors))
+    with open(filename + '.vrt', 'w') as f:
+        f.write(vrt_xml(grid, [(filename, source_info(filename))], overviews))
+    rasterio.shutil.copy(filename + '.vrt', cog_filename, driver='COG',
+                         compress='deflate', predictor=2, bigtiff='yes',
+                         blocksize=BLOCK_SIZE, overviews='FORCE_USE_EXISTING',
+                         num_threads='ALL_CPUS')
+    for scratch in [filename, filename + '.vrt'] + overviews:
+        os.remove(scratch)
+
 
 def merge(name: str,
           input_s3_uri: str,
           output_s3_uri: str,
-          local_working_dir: str = '/tmp'):
+          local_working_dir: str = '/tmp',
+          bounds: Optional[List[float]] = None,
+          shards: int = 1,
+          shard: Optional[int] = None,
+          incremental: bool = True,
+          cache_size: int = 256,
+          cog: bool = False,
+          vrt: bool = False,
+          metrics: Optional[str] = None):
+    start = usage()
 
     assert input_s3_uri.endswith('/')
     assert output_s3_uri.endswith('/')
     assert not local_working_dir.endswith('/')
+    assert (len(bounds) == 4 if bounds is not None else True)
+    assert (bounds is not None if shard is not None else True)
+    assert (0 <= shard < shards if shard is not None else True)
 
     def working(filename):
         return os.path.join(local_working_dir, filename)
 
-    cloudless_tif = working('{}-cloudless.tif'.format(name))
-    cloudy_tif = working('{}-cloudy.tif'.format(name))
-
-    # Download
-    os.system(''.join([
-       'aws s3 sync ',
-       '{} '.format(input_s3_uri),
-       '{}/ '.format(local_working_dir),
-       '--exclude="*" --include="*.tif" --exclude="mask*.tif"'
-    ]))
-    backstops = int(
-        os.popen('ls {} | wc -l'.format(working('backstop*.tif'))).read())
-
-    # Produce final images
-    if backstops > 0:
-        # merge backstops to backstop
-        os.system(''.join([
-            'gdalwarp ',
-            '$(ls {} | grep backstop | sort -r) '.format(working('*.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co TILED=YES -co BIGTIFF=YES ',
-            '{}'.format(working('cloudy.tif'))
-        ]))
-        # compress backstop
-        os.system(''.join([
-            'gdalwarp {} '.format(working('cloudy.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co COMPRESS=DEFLATE -co PREDICTOR=2 ',
-            '-co TILED=YES -co SPARSE_OK=YES -co BIGTIFF=YES '
-            '{}'.format(cloudy_tif)
-        ]))
-        # delete scratch backstop
-        os.system('rm {}'.format(working('cloudy.tif')))
-        # upload backstop
-        os.system(''.join([
-            'aws s3 cp ',
-            '{} '.format(cloudy_tif),
-            '{}'.format(output_s3_uri)
-        ]))
-        # merge imagery including backstop
-        os.system(''.join([
-            'gdalwarp ',
-            '{} '.format(cloudy_tif),
-            '$(ls {} | grep -v backstop | grep -v cloudy | grep -v mask | sort -r) '.format(working('*.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co TILED=YES -co BIGTIFF=YES ',
-            '{}'.format(working('cloudless.tif'))
-        ]))
-        # compress imagery
-        os.system(''.join([
-            'gdalwarp ',
-            '{} '.format(working('cloudless.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co COMPRESS=DEFLATE -co PREDICTOR=2 ',
-            '-co TILED=YES -co SPARSE_OK=YES -co BIGTIFF=YES ',
-            '{}'.format(cloudless_tif)
-        ]))
-        # delete scratch imagery
-        os.system('rm {}'.format(working('cloudless.tif')))
+    # Remove downloaded files that are no longer needed
+    def discard(filenames):
+        for filename in filenames:
+            if os.path.isfile(working(filename)):
+                os.remove(working(filename))
+
+    # Every run, however it ends, leaves a record for sizing (named by
+    # its start, so that reruns do not replace earlier records)
+    def recorded(grid, dirty):
+        if metrics is not None:
+            record_metrics(metrics, working('{}-merge-{:.0f}.json'.format(name, start[0])), start, {
+                'job': 'merge',
+                'inputs': len(sources),
+                'dirty': dirty,
+                'window_pixels': grid.get('width') * grid.get('height') if grid is not None else 0,
+                'bands': grid.get('count') if grid is not None else 0,
+                'cache_size': cache_size,
+                'cog': cog,
+                'vrt': vrt,
+            })
+
+    if shard is not None:
+        name = shard_name(name, shard)
+        bounds = shard_bounds(bounds, shards)[shard]
+
+    cloudless_tif = '{}-cloudless.tif'.format(name)
+    cloudy_tif = '{}-cloudy.tif'.format(name)
+    manifest_json = '{}-manifest.json'.format(name)
+
+    # The manifest from the previous run (if any) records the grid,
+    # the checksum of every source, and which sources intersect each
+    # tile of the output.
+    sources = list_sources(input_s3_uri)
+    old_manifest = None
+    if incremental and copy_uri(output_s3_uri + manifest_json, working(manifest_json)) == 0:
+        with open(working(manifest_json), 'r') as f:
+            old_manifest = json.load(f)
+        old_sources = old_manifest.get('sources')
     else:
-        # merge imagery
-        os.system(''.join([
-            'gdalwarp ',
-            '$(ls {} | grep -v backstop | grep -v cloudy | grep -v mask | sort -r) '.format(working('*.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co TILED=YES -co BIGTIFF=YES ',
-            '{}'.format(working('cloudless.tif'))
-        ]))
-        # compress imagery
-        os.system(''.join([
-            'gdalwarp ',
-            '{} '.format(working('cloudless.tif')),
-            '-multi ',
-            '-co NUM_THREADS=ALL_CPUS -wo NUM_THREADS=ALL_CPUS ',
-            '-oo NUM_THREADS=ALL_CPUS -doo NUM_THREADS=ALL_CPUS ',
-            '-co COMPRESS=DEFLATE -co PREDICTOR=2 ',
-            '-co TILED=YES -co SPARSE_OK=YES -co BIGTIFF=YES ',
-            '{}'.format(cloudless_tif)
-        ]))
-        # delete scratch imagery
-        os.system('rm {}'.format(working('cloudless.tif')))
+        old_sources = {}
+
+    # Sources are read in place, a window at a time, rather than being
+    # downloaded.  GDAL fetches the needed byte ranges and keeps
+    # recently-used blocks in a cache of bounded size.  Every needed
+    # source is open at once, so the caches must be the ones that are
+    # shared by all files (VSI_CACHE_SIZE would apply to each): half of
+    # `cache_size` goes to fetched byte ranges, half to decoded blocks
+    # (rasterio takes an integer GDAL_CACHEMAX to be in bytes).
+    def source(filename):
+        return vsi_uri(input_s3_uri) + filename
+
+    with rio.Env(CPL_VSIL_CURL_CACHE_SIZE=(cache_size - cache_size // 2) * (1 << 20),
+                 GDAL_CACHEMAX=(cache_size // 2) * (1 << 20),
+                 GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+                 CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif'):
+        # Information about unchanged sources comes from the old manifest,
+        # other sources must be inspected
+        infos = {}
+        for (filename, etag) in sources.items():
+            if old_sources.get(filename, {}).get('etag') == etag:
+                infos[filename] = old_sources.get(filename).get('info')
+            else:
+                infos[filename] = source_info(source(filename))
+        if len(infos) == 0:
+            discard([manifest_json])
+            recorded(None, 0)
+            return
+
+        grid = output_grid(infos, bounds)
+        backstops = sorted(filter(lambda s: s.startswith('backstop'), sources))
+        regulars = sorted(filter(lambda s: not s.startswith('backstop'), sources))
+        products = [cloudless_tif, cloudy_tif] if len(backstops) > 0 else [cloudless_tif]
+
+        # Without backstops there is no cloudy product, so one left by an
+        # earlier run is stale
+        if len(backstops) == 0:
+            stale = cloudy_tif.replace('.tif', '.vrt') if vrt else cloudy_tif
+            if stale in list_objects(output_s3_uri):
+                remove_uri(output_s3_uri + stale)
+
+        # A VRT mosaic refers to the sources in place, in the same order
+        # of priority as used below, so no pixels are copied
+        if vrt:
+            mosaics = [regulars + backstops, backstops] if len(backstops) > 0 else [regulars]
+            for (product, mosaic) in zip(products, mosaics):
+                product_vrt = product.replace('.tif', '.vrt')
+                with open(working(product_vrt), 'w') as f:
+                    f.write(vrt_xml(grid, [(source(s), infos.get(s)) for s in mosaic]))
+                copy_uri(working(product_vrt), output_s3_uri)
+                os.remove(working(product_vrt))
+            discard([manifest_json])
+            recorded(grid, 0)
+            return
+
+        # Determine which tiles must be (re)computed
+        tiles = {}
+        dirty = []
+        for window in grid_tiles(grid):
+            key = tile_key(window)
+            tile_bounds = list(rasterio.windows.bounds(
+                window, rasterio.Affine(*grid.get('transform'))))
+            tiles[key] = sorted(filter(lambda s: intersects(
+                infos.get(s).get('bounds'), tile_bounds), sources))
+            if old_manifest is not None:
+                old_tile = old_manifest.get('tiles').get(key)
+                if old_tile == tiles.get(key) and all(map(
+                        lambda s: old_sources.get(s).get('etag') == sources.get(s), old_tile)):
+                    continue
+            dirty.append(window)
+
+        # Update the previous products in place if possible, otherwise
+        # start from scratch
+        update = (old_manifest is not None and old_manifest.get('grid') == grid and
+                  old_manifest.get('cog', False) == cog)
+        if update:
+            for product in products:
+                code = copy_uri(output_s3_uri + product, working(product))
+                update = update and code == 0
+        if not update:
+            dirty = list(grid_tiles(grid))
+        print('{} of {} tiles need to be computed'.format(len(dirty), len(tiles)))
+        if len(dirty) == 0:
+            discard(products + [manifest_json])
+            recorded(grid, 0)
+            return
+
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'uint16',
+            'nodata': 0,
+            'count': grid.get('count'),
+            'crs': grid.get('crs'),
+            'transform': rasterio.Affine(*grid.get('transform')),
+            'width': grid.get('width'),
+            'height': grid.get('height'),
+            'tiled': True,
+            'blockxsize': BLOCK_SIZE,
+            'blockysize': BLOCK_SIZE,
+            'compress': 'deflate',
+            'predictor': 2,
+            'bigtiff': 'yes',
+            'sparse_ok': True,
+        }
+
+        # Non-COG products are updated in place.  COGs cannot be, so
+        # they are rebuilt with unchanged tiles (and their overviews)
+        # copied from the previous products.
+        if not cog and update:
+            outputs = [rio.open(working(product), 'r+') for product in products]
+        elif not cog:
+            outputs = [rio.open(working(product), 'w', **profile) for product in products]
+        else:
+            factors = overview_factors(grid.get('width'), grid.get('height'))
+            outputs = [rio.open(working('scratch-' + product), 'w', **profile)
+                       for product in products]
+            levels = [open_levels(working('scratch-' + product), profile, factors)
+                      for product in products]
+            if update:
+                olds = [[rio.open(working(product), 'r')] +
+                        [rio.open(working(product), 'r', overview_level=level)
+                         for level in range(len(factors))]
+                        for product in products]
+
+        # Produce final images.  Sources are ordered from highest to
+        # lowest priority and only fill pixels not yet filled by others.
+        # Once a tile is full, lower-priority sources need not be read.
+        needed = sorted(set(s for window in dirty for s in tiles.get(tile_key(window))))
+        datasets = {s: rio.open(source(s), 'r') for s in needed}
+        dirty_keys = set(map(tile_key, dirty))
+        for window in grid_tiles(grid):
+            if tile_key(window) not in dirty_keys:
+                if cog and update:
+                    for (old, output, level) in zip(olds, outputs, levels):
+                        output.write(old[0].read(window=window), window=window)
+                        for (factor, ds, old_level) in zip(factors, level, old[1:]):
+                            level_window = decimate_window(window, factor)
+                            ds.write(old_level.read(window=level_window), window=level_window)
+                continue
+            tile = np.zeros((grid.get('count'), window.height, window.width), dtype=np.uint16)
+            for filename in filter(lambda s: s in tiles.get(tile_key(window)), regulars):
+                if fill_tile(datasets.get(filename), grid, window, tile):
+                    break
+            products_tiles = [tile]
+            if len(backstops) > 0:
+                backstop_tile = np.zeros(tile.shape, dtype=np.uint16)
+                for filename in filter(lambda s: s in tiles.get(tile_key(window)), backstops):
+                    if fill_tile(datasets.get(filename), grid, window, backstop_tile):
+                        break
+                empty = ~(tile.any(axis=0))
+                tile[:, empty] = backstop_tile[:, empty]
+                products_tiles.append(backstop_tile)
+            for (output, product_tile) in zip(outputs, products_tiles):
+                output.write(product_tile, window=window)
+            # Overviews are decimated from each tile as it is written
+            if cog:
+                for (level, product_tile) in zip(levels, products_tiles):
+                    for (factor, ds) in zip(factors, level):
+                        ds.write(product_tile[:, ::factor, ::factor],
+                                 window=decimate_window(window, factor))
+        for ds in list(datasets.values()) + outputs:
+            ds.close()
+
+        if cog:
+            for level in levels:
+                for ds in level:
+                    ds.close()
+            if update:
+                for old in olds:
+                    for ds in old:
+                        ds.close()
+            for product in products:
+                write_cog(working('scratch-' + product), factors, working(product))
+
+    # Record the manifest for the next run
+    manifest = {
+        'cog': cog,
+        'grid': grid,
+        'sources': {s: {'etag': sources.get(s), 'info': infos.get(s)} for s in sources},
+        'tiles': tiles,
+    }
+    with open(working(manifest_json), 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=4, separators=(',', ': '))
 
     # Upload
-    os.system('aws s3 cp {} {}'.format(cloudless_tif, output_s3_uri))
+    for product in products + [manifest_json]:
+        copy_uri(working(product), output_s3_uri)
+        os.remove(working(product))
+
+    recorded(grid, len(dirty))
+
+
+# Stitch the outputs of sharded merges (found at output_s3_uri) into a
+# single mosaic.  A VRT refers to the shards in place, whereas a COG is
+# a self-contained copy.  The shards may themselves be VRTs (see the
+# `vrt` argument of merge).
+def assemble(name: str,
+             shards: int,
+             output_s3_uri: str,
+             local_working_dir: str = '/tmp',
+             assemble_format: str = 'vrt'):
+
+    assert output_s3_uri.endswith('/')
+    assert not local_working_dir.endswith('/')
+    assert assemble_format in ['vrt', 'cog']
+
+    def working(filename):
+        return os.path.join(local_working_dir, filename)
+
+    listing = list_objects(output_s3_uri)
+
+    for kind in ['cloudless', 'cloudy']:
+        sources = []
+        for shard in range(shards):
+            for extension in ['tif', 'vrt']:
+                filename = '{}-{}.{}'.format(shard_name(name, shard), kind, extension)
+                if filename in listing:
+                    sources.append(vsi_uri(output_s3_uri) + filename)
+                    break
+        if len(sources) == 0:
+            continue
+
+        vrt = working('{}-{}.vrt'.format(name, kind))
+        os.system('gdalbuildvrt {} {}'.format(vrt, ' '.join(sources)))
+
+        if assemble_format == 'vrt':
+            copy_uri(vrt, output_s3_uri)
+        elif assemble_format == 'cog':
+            tif = working('{}-{}.tif'.format(name, kind))
+            os.system(''.join([
+                'gdal_translate {} '.format(vrt),
+                '-of COG ',
+                '-co NUM_THREADS=ALL_CPUS ',
+                '-co COMPRESS=DEFLATE -co PREDICTOR=2 -co BIGTIFF=YES ',
+                '{}'.format(tif)
+            ]))
+            copy_uri(tif, output_s3_uri)
+            os.system('rm {}'.format(tif))
+        os.system('rm {}'.format(vrt))
 
 
 if __name__ == '__main__':
     import argparse
+    import ast
 
     def cli_parser() -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser()
-        parser.add_argument('--input-path', required=True, type=str)
+        parser.add_argument('--input-path', required=False, type=str)
         parser.add_argument('--name', required=True, type=str)
         parser.add_argument('--output-path', required=True, type=str)
         parser.add_argument('--tmp', required=False, type=str, default='/tmp')
+        parser.add_argument('--bounds', required=False, nargs='+', type=float)
+        parser.add_argument('--shards', required=False, default=1, type=int)
+        parser.add_argument('--shard', required=False, type=int)
+        parser.add_argument('--assemble', required=False,
+                            default=False, type=ast.literal_eval)
+        parser.add_argument('--assemble-format', required=False,
+                            choices=['vrt', 'cog'], default='vrt')
+        parser.add_argument('--incremental', required=False,
+                            default=True, type=ast.literal_eval)
+        parser.add_argument('--cache-size', required=False, default=256, type=int,
+                            help='The total size (in MB) of the caches for reading the inputs')
+        parser.add_argument('--cog', required=False,
+                            default=False, type=ast.literal_eval)
+        parser.add_argument('--vrt', required=False,
+                            default=False, type=ast.literal_eval)
+        parser.add_argument('--metrics', required=False, type=str,
+                            help='Where to record the resources that the merge used')
         return parser
 
-    args = cli_parser().parse_args()
+    parser = cli_parser()
+    args = parser.parse_args()
+
+    if args.assemble:
+        assemble(args.name, args.shards, args.output_path,
+                 local_working_dir=args.tmp,
+                 assemble_format=args.assemble_format)
+        sys.exit(0)
+
+    if args.input_path is None:
+        parser.error('--input-path is required unless assembling')
+
+    # Children of an array job find their shard in the environment
+    if args.shard is None and args.shards > 1:
+        if os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX') is None:
+            parser.error('--shard is required outside an array job')
+        args.shard = int(os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX'))
 
-    merge(args.name, args.input_path, args.output_path, local_working_dir=args.tmp)
+    merge(args.name, args.input_path, args.output_path,
+          local_working_dir=args.tmp,
+          bounds=args.bounds,
+          shards=args.shards,
+          shard=args.shard,
+          incremental=args.incremental,
+          cache_size=args.cache_size,
+          cog=args.cog,
+          vrt=args.vrt,
+          metrics=args.metrics)
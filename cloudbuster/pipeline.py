@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+try:
+    from .executors import BatchExecutor, LocalExecutor, gather_job, merge_jobs, submit_chain
+    from .filter import filter_response, write_selections
+    from .query_rf import query_scenes
+    from .scenes import read_response, write_response
+except ImportError:
+    from executors import BatchExecutor, LocalExecutor, gather_job, merge_jobs, submit_chain  # type: ignore
+    from filter import filter_response, write_selections  # type: ignore
+    from query_rf import query_scenes  # type: ignore
+    from scenes import read_response, write_response  # type: ignore
+
+# The states of Batch jobs that may yet succeed
+ACTIVE = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING']
+
+
+# A hash of the (JSON-serializable) inputs of a task
+def digest(inputs) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+# The checksums of files, or None for those that do not exist.  Objects
+# on S3 are identified by their ETags (which are listed once per
+# prefix), local files by the SHA-256 of their contents.
+def checksums(uris: List[str]) -> Dict[str, Optional[str]]:
+    retval: Dict[str, Optional[str]] = {}
+    listings: Dict[tuple, Dict[str, str]] = {}
+    for uri in uris:
+        parsed = urlparse(uri)
+        if parsed.scheme == 's3':
+            key = parsed.path.lstrip('/')
+            prefix = key[0:key.rfind('/')+1]
+            if (parsed.netloc, prefix) not in listings:
+                import boto3
+                paginator = boto3.client('s3').get_paginator('list_objects_v2')
+                listing = {}
+                for page in paginator.paginate(Bucket=parsed.netloc, Prefix=prefix, Delimiter='/'):
+                    for obj in page.get('Contents', []):
+                        listing[obj.get('Key')] = obj.get('ETag').strip('"')
+                listings[(parsed.netloc, prefix)] = listing
+            retval[uri] = listings[(parsed.netloc, prefix)].get(key)
+        elif os.path.isfile(uri):
+            h = hashlib.sha256()
+            with open(uri, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            retval[uri] = h.hexdigest()
+        else:
+            retval[uri] = None
+    return retval
+
+
+# The record of the tasks of a pipeline.  Each task is identified by a
+# key and has a hash of its inputs, the checksums of its outputs, a
+# state ("done" or "submitted") and, if submitted to Batch, a job id.
+# The record is rewritten after every change, so that progress
+# survives interruptions (unless it is read-only, as for dry runs).
+class Manifest:
+
+    def __init__(self, filename: Optional[str], readonly: bool = False):
+        self.filename = filename
+        self.readonly = readonly
+        self.tasks: Dict[str, dict] = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.tasks = json.load(f).get('tasks')
+
+    def save(self) -> None:
+        if self.filename is None or self.readonly:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'tasks': self.tasks}, f, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(tmp, self.filename)
+
+    def record(self, key: str, inputs: str, outputs: Dict[str, Optional[str]],
+               state: str = 'done', job: Optional[str] = None) -> None:
+        self.tasks[key] = {'inputs': inputs, 'outputs': outputs, 'state': state}
+        if job is not None:
+            self.tasks[key]['job'] = job
+        self.save()
+
+    def outputs(self, key: str) -> Dict[str, Optional[str]]:
+        return self.tasks.get(key, {}).get('outputs', {})
+
+    # The inputs that a task recorded in the given state must have.  A
+    # task submitted before its inputs were settled (a merge whose
+    # gathers were still running) is recorded under `provisional` ones.
+    def expected(self, task: dict, inputs: str, provisional: Optional[str]) -> str:
+        if task.get('state') == 'submitted' and provisional is not None:
+            return provisional
+        return inputs
+
+    # Whether the task has been done with the same inputs and its
+    # outputs are (still) as they were.  A task that was submitted to
+    # Batch is done once all of its outputs exist, and from then on
+    # has the settled inputs.
+    def done(self, key: str, inputs: str, current: Dict[str, Optional[str]],
+             provisional: Optional[str] = None) -> bool:
+        task = self.tasks.get(key)
+        if task is None or task.get('inputs') != self.expected(task, inputs, provisional):
+            return False
+        outputs = task.get('outputs')
+        if any(map(lambda uri: current.get(uri) is None, outputs.keys())):
+            return False
+        if task.get('state') == 'submitted':
+            self.record(key, inputs, dict(map(lambda uri: (uri, current.get(uri)), outputs.keys())))
+            return True
+        return all(map(lambda uri: current.get(uri) == outputs.get(uri), outputs.keys()))
+
+    # The id of the Batch job that is (still) working on the task with
+    # the same inputs, if any
+    def in_flight(self, key: str, inputs: str, executor, provisional: Optional[str] = None) -> Optional[str]:
+        task = self.tasks.get(key)
+        if task is None or task.get('state') != 'submitted':
+            return None
+        if task.get('inputs') != self.expected(task, inputs, provisional):
+            return None
+        if executor.status(task.get('job')) in ACTIVE:
+            return task.get('job')
+        return None
+
+
+# The name under which gather saves the image of a selection
+def gather_filename(name: str, entry: dict) -> str:
+    name_pattern = '{}-{:02d}'.format(name, entry.get('index'))
+    return 'backstop-{}.tif'.format(name_pattern) if entry.get('backstop') else '{}.tif'.format(name_pattern)
+
+
+# The names under which merge (or assemble) saves the mosaic
+def merge_filenames(name: str, entries: List[dict], shards: int = 1,
+                    assemble_format: str = 'vrt', vrt: bool = False, **kwargs) -> List[str]:
+    extension = 'vrt' if (shards > 1 and assemble_format == 'vrt') or (shards == 1 and vrt) else 'tif'
+    kinds = ['cloudless', 'cloudy'] if any(map(lambda entry: entry.get('backstop'), entries)) else ['cloudless']
+    return list(map(lambda kind: '{}-{}.{}'.format(name, kind, extension), kinds))
+
+
+# Run (or resume) the whole pipeline: the query, the filter, a gather
+# for each selection and the merge.  The query and the filter run in
+# this process; the gathers and the merge are run by executors made by
+# `make_executor` (which is given the jobs to size them for).  Returns
+# False if the pipeline could not be finished (or, with Batch, could
+# not be submitted).  A dry run writes nothing: the query and the
+# filter are only reported if they are not done (and then the
+# pipeline stops there), and the executors are expected to be dry.
+def run_pipeline(config: dict, manifest: Manifest, make_executor, dryrun: bool = False) -> bool:
+    name = config.get('name')
+    workdir = config.get('workdir', '.')
+    if not dryrun:
+        os.makedirs(workdir, exist_ok=True)
+
+    # Query
+    with open(config.get('geojson'), 'r') as f:
+        features = json.load(f)
+    query_args = config.get('query', {})
+    raw = os.path.join(workdir, '{}-raw.json'.format(name))
+    inputs = digest({'features': features, 'query': query_args})
+    if manifest.done('query', inputs, checksums([raw])):
+        print('query: done')
+    elif dryrun:
+        print('query: not done')
+        return True
+    else:
+        print('query')
+        response = query_scenes(features, None, **query_args)
+        scenes = response.pop('results')
+        write_response(raw, response, scenes)
+        manifest.record('query', inputs, checksums([raw]))
+
+    # Filter
+    filter_args = config.get('filter', {})
+    filtered = os.path.join(workdir, '{}.json'.format(name))
+    inputs = digest({'response': manifest.outputs('query'), 'filter': filter_args})
+    if manifest.done('filter', inputs, checksums([filtered])):
+        print('filter: done')
+    elif dryrun:
+        print('filter: not done')
+        return True
+    else:
+        print('filter')
+        (response, scenes) = read_response(raw)
+        response['results'] = scenes
+        selections, not_backstopped, not_covered = filter_response(response, **filter_args)
+        for stale in [filtered, filtered + '.ERROR']:
+            if os.path.exists(stale):
+                os.remove(stale)
+        write_selections(selections, not_backstopped, not_covered, filtered,
+                         backstop_bool=filter_args.get('backstop_bool', True),
+                         coverage_count=filter_args.get('coverage_count', 3))
+        if not os.path.exists(filtered):
+            return False
+        manifest.record('filter', inputs, checksums([filtered]))
+
+    with open(filtered, 'r') as f:
+        response = json.load(f)
+
+    # Only Batch jobs of earlier runs can still be running
+    status_executor = make_executor([])
+    try:
+        return run_jobs(config, manifest, make_executor, status_executor, response)
+    finally:
+        status_executor.shutdown()
+
+
+# Run (or resume) the gathers of the selections of the filtered
+# response and the merge of their images (see `run_pipeline`)
+def run_jobs(config: dict, manifest: Manifest, make_executor, status_executor, response: dict) -> bool:
+    name = config.get('name')
+    results = response.get('selections')
+
+    # Gathers
+    gather_args = dict(config.get('gather'))
+    output_path = gather_args.pop('output_path')
+    index_start = gather_args.pop('index_start', 1)
+    tmp = gather_args.pop('tmp', '/tmp')
+    gather_resources = dict(map(lambda k: (k, gather_args.pop(k)),
+                                filter(lambda k: k in gather_args, ['vcpus', 'memory', 'pack'])))
+    if gather_args.pop('bounds_clip', True):
+        gather_args['bounds'] = response.get('bounds')
+    if gather_args.pop('grid_align', True):
+        gather_args['grid'] = response.get('grid')
+    batch_args = config.get('batch', {})
+
+    entries = []
+    for (i, result) in enumerate(results):
+        entries.append({
+            'backstop': result.get('backstop', False),
+            'index': i + index_start,
+            'sentinel_path': result.get('sceneMetadata').get('path'),
+        })
+    keys = list(map(lambda entry: 'gather-{}'.format(entry.get('index')), entries))
+    gather_inputs = list(map(lambda entry: digest({'selection': entry, 'gather': gather_args}), entries))
+    gather_outputs = list(map(lambda entry: output_path + gather_filename(name, entry), entries))
+    current = checksums(gather_outputs)
+
+    pending = []
+    handles = []
+    in_flight = 0
+    for (key, inputs, entry) in zip(keys, gather_inputs, entries):
+        if manifest.done(key, inputs, current):
+            continue
+        job_id = manifest.in_flight(key, inputs, status_executor)
+        if job_id is not None:
+            in_flight += 1
+            if job_id not in handles:
+                handles.append(job_id)
+        else:
+            pending.append(entry)
+    print('gather: {} of {} done, {} in flight'.format(
+        len(entries) - len(pending) - in_flight, len(entries), in_flight))
+
+    failures = 0
+    if len(pending) > 0:
+        # Each set of children gets its own manifest, so that children
+        # of earlier jobs that are still running are not confused
+        job = gather_job(name, output_path, pending,
+                         gather=batch_args.get('gather'),
+                         manifest='{}{}-gather-manifest-{}.json'.format(
+                             output_path, name, digest(pending)[0:12]),
+                         tmp=tmp,
+                         metrics=config.get('metrics'),
+                         **gather_resources,
+                         **gather_args)
+        executor = make_executor([job])
+        handle = executor.submit(job)
+        positions = dict(map(lambda i: (entries[i].get('index'), i), range(len(entries))))
+
+        def finished(j, future):
+            nonlocal failures
+            i = positions.get(pending[j].get('index'))
+            if future.exception() is not None:
+                print('{}: {}'.format(keys[i], future.exception()))
+                failures += 1
+            elif any(future.result()):
+                failures += 1
+            else:
+                manifest.record(keys[i], gather_inputs[i], checksums([gather_outputs[i]]))
+
+        if executor.asynchronous:
+            for entry in pending:
+                i = positions.get(entry.get('index'))
+                manifest.record(keys[i], gather_inputs[i],
+                                dict.fromkeys([gather_outputs[i]]), state='submitted', job=handle)
+            handles.append(handle)
+        else:
+            executor.wait(handle, callback=finished)
+        executor.shutdown()
+    if failures > 0:
+        print('{} of {} gathers failed'.format(failures, len(pending)))
+        return False
+
+    # Merge
+    merge_args = dict(config.get('merge', {}))
+    merge_path = merge_args.pop('output_path', output_path)
+    tmp = merge_args.pop('tmp', tmp)
+    merge_resources = dict(map(lambda k: (k, merge_args.pop(k)),
+                               filter(lambda k: k in merge_args, ['vcpus', 'memory'])))
+    if merge_args.get('shards', 1) > 1:
+        merge_args['bounds'] = response.get('bounds')
+    merge_outputs = list(map(lambda filename: merge_path + filename,
+                             merge_filenames(name, entries, **merge_args)))
+    # Like the filter, the merge depends on what its inputs produced;
+    # when submitted to Batch before the gathers have finished, it can
+    # only be recorded under their arguments until it is done.
+    provisional = digest({'gathers': gather_inputs, 'merge': merge_args})
+    inputs = digest({'gathers': gather_inputs, 'merge': merge_args,
+                     'outputs': list(map(manifest.outputs, keys))})
+    if manifest.done('merge', inputs, checksums(merge_outputs), provisional):
+        print('merge: done')
+        return True
+    if manifest.in_flight('merge', inputs, status_executor, provisional) is not None:
+        print('merge: in flight')
+        return True
+    print('merge')
+    jobs = merge_jobs(name, output_path, merge_path,
+                      merge=batch_args.get('merge'),
+                      tmp=tmp,
+                      inputs=len(entries),
+                      metrics=config.get('metrics'),
+                      **merge_resources,
+                      **merge_args)
+    jobs[0].depends_on = handles
+    executor = make_executor(jobs)
+    handle = submit_chain(executor, jobs)
+    if executor.asynchronous:
+        manifest.record('merge', provisional, dict.fromkeys(merge_outputs), state='submitted', job=handle)
+    else:
+        executor.wait(handle)
+        manifest.record('merge', inputs, checksums(merge_outputs))
+    executor.shutdown()
+    return True
+
+
+def cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True, type=str,
+                        help='The pipeline (JSON)')
+    parser.add_argument('--manifest', required=False, type=str,
+                        help='The record of finished tasks (by default WORKDIR/NAME-pipeline.json)')
+    parser.add_argument('--executor', required=False,
+                        choices=['batch', 'local'], default='batch')
+    parser.add_argument('--workers', required=False, type=int,
+                        help='The most jobs to run at once with the local executor')
+    parser.add_argument('--dryrun', required=False,
+                        default=False, type=ast.literal_eval)
+    return parser
+
+
+if __name__ == '__main__':
+    import sys
+
+    parser = cli_parser()
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    batch_args = config.get('batch', {})
+    if args.executor == 'batch' and None in list(map(batch_args.get, ['jobqueue', 'jobdef', 'gather', 'merge'])):
+        parser.error('jobqueue, jobdef, gather and merge must be given in the "batch" section of the pipeline')
+    if args.manifest is None:
+        args.manifest = os.path.join(config.get('workdir', '.'), '{}-pipeline.json'.format(config.get('name')))
+
+    # Workers must fit every job of a chain (the shards of a merge and
+    # its assembly)
+    def make_executor(jobs):
+        if args.executor == 'batch':
+            return BatchExecutor(batch_args.get('jobqueue'), batch_args.get('jobdef'), dryrun=args.dryrun)
+        elif len(jobs) == 0:
+            return LocalExecutor(workers=1, dryrun=args.dryrun)
+        else:
+            return LocalExecutor(vcpus=max(map(lambda job: job.vcpus, jobs)),
+                                 memory=max(map(lambda job: job.memory, jobs)),
+                                 workers=args.workers,
+                                 scratch_root=config.get('gather').get('tmp', '/tmp'),
+                                 dryrun=args.dryrun)
+
+    manifest = Manifest(args.manifest, readonly=args.dryrun)
+    if not run_pipeline(config, manifest, make_executor, dryrun=args.dryrun):
+        sys.exit(-1)
@@ -26,27 +26,188 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import json
+import concurrent.futures
 import copy
+import hashlib
+import json
+import math
+import os
+import time
+from typing import List, Optional
 
-from satsearch import Search
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import shapely.affinity  # type: ignore
 import shapely.geometry  # type: ignore
 import shapely.ops  # type: ignore
+import shapely.wkt  # type: ignore
+
+try:
+    from . import catalog
+    from .s2grid import load_index, tile_parts
+    from .scenes import Scene, write_response
+except ImportError:
+    import catalog  # type: ignore
+    from s2grid import load_index, tile_parts  # type: ignore
+    from scenes import Scene, write_response  # type: ignore
+
+STAC_URL = 'https://earth-search.aws.element84.com/v0'
+
+
+# A session whose connections are pooled across threads and whose
+# requests are retried, with backoff, on throttling and server errors
+def stac_session(workers: int = 8, retries: int = 5) -> requests.Session:
+    kwargs = {
+        'total': retries,
+        'backoff_factor': 0.5,
+        'status_forcelist': [429, 500, 502, 503, 504],
+    }
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET', 'POST']), **kwargs)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET', 'POST']), **kwargs)
+    adapter = HTTPAdapter(max_retries=retry,
+                          pool_connections=workers,
+                          pool_maxsize=workers)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def search_page(session: requests.Session, url: str, body: dict, page: int) -> dict:
+    body = copy.copy(body)
+    body['page'] = page
+    response = session.post('{}/search'.format(url), json=body, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+# The number of items that a search matched, if the server says
+def matched(page: dict):
+    context = page.get('context', {})
+    if 'matched' in context:
+        return context.get('matched')
+    return page.get('numberMatched')
+
+
+# Run one search per date range, fetching the pages of all of the
+# searches concurrently.  The first page of each search tells how many
+# more pages are needed (if the server reports how many items matched;
+# otherwise pages are fetched one after another until a short one
+# arrives).  Returns the items of each search, in order, up to the
+# limit.
+def search_ranges(session: requests.Session,
+                  url: str,
+                  bodies: List[dict],
+                  limit: int,
+                  page_size: int,
+                  workers: int) -> List[List[dict]]:
+    pages = [dict() for body in bodies]
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(r, page):
+            future = executor.submit(search_page, session, url, bodies[r], page)
+            futures[future] = (r, page)
 
-def query_rf(features,
-             refresh_token,
-             limit=800,
-             minclouds=0.0,
-             maxclouds=20.0,
-             mindate=['1307-10-13'],
-             maxdate=['2038-01-19'],
-             scale=None,
-             original_shape=False):
+        futures = {}
+        for r in range(len(bodies)):
+            submit(r, 1)
+        while len(futures) > 0:
+            (done, _) = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (r, page) = futures.pop(future)
+                result = future.result()
+                features = result.get('features', [])
+                pages[r][page] = features
+                wanted = int(math.ceil(limit / page_size))
+                if page == 1 and matched(result) is not None:
+                    wanted = min(wanted, int(math.ceil(matched(result) / page_size)))
+                    for later in range(2, wanted + 1):
+                        submit(r, later)
+                elif matched(result) is None and len(features) == page_size and page < wanted:
+                    submit(r, page + 1)
+
+    items = []
+    for r in range(len(bodies)):
+        ranged = []
+        for page in sorted(pages[r].keys()):
+            ranged.extend(pages[r][page])
+        items.append(ranged[0:limit])
+    return items
+
+
+# The cache key of a search: a hash of everything that determines its
+# results.  The geometry is normalized (and rounded) so that the same
+# shape written differently hits the same entry.
+def cache_key(url: str, body: dict, limit: int) -> str:
+    intersects = None
+    if 'intersects' in body:
+        geometry = shapely.geometry.shape(body.get('intersects')).normalize()
+        intersects = shapely.wkt.dumps(geometry, rounding_precision=9)
+    key = {
+        'url': url.rstrip('/'),
+        'intersects': intersects,
+        'datetime': body.get('datetime'),
+        'query': body.get('query'),
+        'collections': sorted(body.get('collections')),
+        'sort': body.get('sort'),
+        'limit': limit,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# The cached items of a search, if they are present and (unless ttl is
+# None) no older than ttl seconds
+def cache_read(cache_dir: str, key: str, ttl: Optional[float]) -> Optional[List[dict]]:
+    filename = os.path.join(cache_dir, '{}.json'.format(key))
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as f:
+        entry = json.load(f)
+    if ttl is not None and time.time() - entry.get('created') > ttl:
+        return None
+    return entry.get('items')
+
+
+def cache_write(cache_dir: str, key: str, items: List[dict]):
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, '{}.json'.format(key))
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'created': time.time(), 'items': items}, f)
+    os.replace(filename + '.tmp', filename)
+
+
+# Query for the scenes that cover the given features.  The results of
+# the response are compact Scene records (see scenes.py); query_rf
+# returns them as dictionaries.
+def query_scenes(features,
+                 refresh_token,
+                 limit=800,
+                 minclouds=0.0,
+                 maxclouds=20.0,
+                 mindate=['1307-10-13'],
+                 maxdate=['2038-01-19'],
+                 scale=None,
+                 original_shape=False,
+                 url=STAC_URL,
+                 page_size=250,
+                 workers=8,
+                 cache_dir=None,
+                 cache_ttl=86400.0,
+                 cache_only=False,
+                 tile_partition=False,
+                 grid_file=None,
+                 backend='stac',
+                 catalog_file=None):
+    assert backend in ['stac', 'catalog']
+    assert backend != 'catalog' or catalog_file is not None
 
     limit = min(limit, 800)
+    page_size = min(page_size, limit)
 
     def convert_and_scale(f):
         tmp = shapely.geometry.shape(f.get('geometry'))
@@ -70,53 +231,98 @@ def query_rf(features,
         'aoi': shapely.geometry.mapping(aoi_shape)
     }
 
+    # Either search for the whole shape at once, or search each of the
+    # Sentinel-2 tiles that it covers by tile id.  Searches for tiles do
+    # not depend on the shape, so AOIs that share tiles share cached
+    # searches.
     rf_shape = shapely.geometry.mapping(shape)
+    if tile_partition:
+        tiles = load_index(grid_file).tiles_for(shape)
+        print('{} tiles'.format(len(tiles)))
+    else:
+        tiles = [None]
+
+    bodies = []
     for (mindate1, maxdate1) in zip(mindate, maxdate):
-        geo_filter = {
-            "url": "https://earth-search.aws.element84.com/v0",
-            "intersects": copy.copy(rf_shape),
-            "query": {
-                "eo:cloud_cover": {
-                    "lte": maxclouds,
-                    "gte": minclouds,
-                }
-            },
-            "datetime": f"{mindate1}/{maxdate1}",
-            "sort": [
-                {
-                    "field": "datetime",
-                    "direction": ">",
-                },
-                # {
-                #     "field": "eo:cloud_cover",
-                #     "direction": "<",
-                # },
-            ],
-            "collections": ["sentinel-s2-l2a"],
-            "limit": limit,
-        }
-        search = Search(**geo_filter)
-        for item in list(search.items(limit=limit))[0:limit]:
-            tiles = item.assets.get("B01").get("href")
-            tiles = tiles[tiles.find("/tiles") + 1:]  # get "/tiles/..."
-            tiles = tiles[:-8]  # remove "/B01.jp2" from the end
-            if tiles.endswith("/R60m"):
-                tiles = tiles[:-5]
-            result = {
-                "dataFootprint": item.geometry,
-                "createdAt": item.properties.get("datetime"),
-                "name": item.properties.get("sentinel:product_id"),
-                "sceneMetadata": {
-                    "cloudyPixelPercentage":
-                    item.properties.get("eo:cloud_cover"),
-                    "path": tiles,
+        for tile in tiles:
+            geo_filter = {
+                "query": {
+                    "eo:cloud_cover": {
+                        "lte": maxclouds,
+                        "gte": minclouds,
+                    }
                 },
+                "datetime": f"{mindate1}/{maxdate1}",
+                "sort": [
+                    {
+                        "field": "datetime",
+                        "direction": ">",
+                    },
+                    # {
+                    #     "field": "eo:cloud_cover",
+                    #     "direction": "<",
+                    # },
+                ],
+                "collections": ["sentinel-s2-l2a"],
+                "limit": page_size,
             }
-            sentinel_scenes['results'].append(result)
+            if tile is None:
+                geo_filter["intersects"] = copy.copy(rf_shape)
+            else:
+                for (k, v) in tile_parts(tile).items():
+                    geo_filter["query"]["sentinel:{}".format(k)] = {"eq": v}
+            bodies.append(geo_filter)
+
+    # A local catalog (see catalog.py) answers every search itself
+    if backend == 'catalog':
+        connection = catalog.open_catalog(catalog_file)
+        ranged = list(map(lambda body: catalog.search(connection, body, limit), bodies))
+        connection.close()
+    else:
+        # Searches that were made recently enough (or at all, when
+        # working offline) are answered from the cache; only the others
+        # are sent to the server.
+        ranged = [None] * len(bodies)
+        if cache_dir is not None:
+            keys = list(map(lambda body: cache_key(url, body, limit), bodies))
+            for r in range(len(bodies)):
+                ranged[r] = cache_read(cache_dir, keys[r], None if cache_only else cache_ttl)
+        missing = list(filter(lambda r: ranged[r] is None, range(len(bodies))))
+        if cache_dir is not None:
+            print('{} of {} searches cached'.format(len(bodies) - len(missing), len(bodies)))
+        if cache_only and len(missing) > 0:
+            raise Exception('{} of {} searches are not cached'.format(len(missing), len(bodies)))
+
+        if len(missing) > 0:
+            session = stac_session(workers=workers)
+            searched = search_ranges(session, url, [bodies[r] for r in missing],
+                                     limit, page_size, workers)
+            for (r, items) in zip(missing, searched):
+                ranged[r] = items
+                if cache_dir is not None:
+                    cache_write(cache_dir, keys[r], items)
+        ranged = list(map(lambda items: list(map(Scene.from_item, items)), ranged))
+
+    product_ids = set()
+    for scenes in ranged:
+        for scene in scenes:
+            if scene.name in product_ids:
+                continue
+            product_ids.add(scene.name)
+            sentinel_scenes['results'].append(scene)
 
     return sentinel_scenes
 
 
+# Query for the scenes that cover the given features, returning a
+# response whose results are dictionaries (as written to response
+# files).  Takes the same arguments as query_scenes.
+def query_rf(features, refresh_token, *args, **kwargs):
+    response = query_scenes(features, refresh_token, *args, **kwargs)
+    response['results'] = list(map(lambda scene: scene.to_result(), response.get('results')))
+    return response
+
+
 if __name__ == '__main__':
     import argparse
     import ast
@@ -152,6 +358,50 @@ if __name__ == '__main__':
                             type=ast.literal_eval,
                             required=False,
                             default=False)
+        parser.add_argument('--stac-url',
+                            type=str,
+                            required=False,
+                            default=STAC_URL)
+        parser.add_argument('--page-size',
+                            type=int,
+                            required=False,
+                            default=250)
+        parser.add_argument('--workers',
+                            type=int,
+                            required=False,
+                            default=8)
+        parser.add_argument('--cache-dir',
+                            type=str,
+                            required=False,
+                            help='Where to cache search results')
+        parser.add_argument('--cache-ttl',
+                            type=float,
+                            required=False,
+                            default=86400.0,
+                            help='How long (in seconds) cached search results remain fresh')
+        parser.add_argument('--cache-only',
+                            type=ast.literal_eval,
+                            required=False,
+                            default=False,
+                            help='Only use cached search results, however old')
+        parser.add_argument('--tile-partition',
+                            type=ast.literal_eval,
+                            required=False,
+                            default=False,
+                            help='Search each Sentinel-2 tile that the AOI covers separately')
+        parser.add_argument('--s2-grid',
+                            type=str,
+                            required=False,
+                            help='The Sentinel-2 grid (a prebuilt index or GeoJSON, possibly xz-compressed)')
+        parser.add_argument('--backend',
+                            type=str,
+                            required=False,
+                            choices=['stac', 'catalog'],
+                            default='stac')
+        parser.add_argument('--catalog',
+                            type=str,
+                            required=False,
+                            help='The SQLite catalog used by the catalog backend')
         return parser
 
     args = cli_parser().parse_args()
@@ -159,15 +409,25 @@ if __name__ == '__main__':
     with open(args.geojson, 'r') as f:
         features = json.load(f)
 
-    sentinel_scenes = query_rf(features=features,
-                               refresh_token=args.refresh_token,
-                               limit=args.limit,
-                               minclouds=args.minclouds,
-                               maxclouds=args.maxclouds,
-                               mindate=args.mindate,
-                               maxdate=args.maxdate,
-                               scale=args.scale,
-                               original_shape=args.original_shape)
+    sentinel_scenes = query_scenes(features=features,
+                                   refresh_token=args.refresh_token,
+                                   limit=args.limit,
+                                   minclouds=args.minclouds,
+                                   maxclouds=args.maxclouds,
+                                   mindate=args.mindate,
+                                   maxdate=args.maxdate,
+                                   scale=args.scale,
+                                   original_shape=args.original_shape,
+                                   url=args.stac_url,
+                                   page_size=args.page_size,
+                                   workers=args.workers,
+                                   cache_dir=args.cache_dir,
+                                   cache_ttl=args.cache_ttl,
+                                   cache_only=args.cache_only,
+                                   tile_partition=args.tile_partition,
+                                   grid_file=args.s2_grid,
+                                   backend=args.backend,
+                                   catalog_file=args.catalog)
 
     if args.aoi_name is None and args.name_property is not None:
         if 'properties' in features:
@@ -181,10 +441,6 @@ if __name__ == '__main__':
 
     print(len(sentinel_scenes.get('results')))
     if args.response is not None:
-        with open(args.response, 'w') as f:
-            json.dump(sentinel_scenes,
-                      f,
-                      sort_keys=True,
-                      indent=4,
-                      separators=(',', ': '))
+        scenes = sentinel_scenes.pop('results')
+        write_response(args.response, sentinel_scenes, scenes)
         print(args.response)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import json
+import lzma
+import os
+import re
+import struct
+from typing import Dict, List, Optional
+
+import shapely.geometry  # type: ignore
+import shapely.strtree  # type: ignore
+import shapely.wkb  # type: ignore
+
+# The Sentinel-2 tiling grid that ships with the repository
+GRID_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'data',
+    'S2A_OPER_GIP_TILPAR_MPC__20151209T095117_V20150622T000000_21000101T000000_B00.geojson.xz')
+
+# The prebuilt index of that grid (see `write_index`), which is
+# installed with the package
+INDEX_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'data',
+    re.sub(r'\.geojson\.xz$', '.index.xz', os.path.basename(GRID_FILE)))
+INDEX_MAGIC = b'S2GRIDX1'
+
+# Indices that have already been loaded, keyed by filename
+INDICES: Dict[str, 'GridIndex'] = {}
+
+
+# The polygons of a grid cell.  Cells are stored as collections of
+# their (possibly several, at the antimeridian) polygons and a label
+# point, with a third coordinate.
+def cell_shape(geometry: dict):
+    shape = shapely.geometry.shape(geometry)
+    if isinstance(shape, shapely.geometry.base.BaseMultipartGeometry):
+        parts = list(getattr(shape, 'geoms', shape))
+    else:
+        parts = [shape]
+    polygons = []
+    for part in parts:
+        if isinstance(part, shapely.geometry.Polygon):
+            polygons.append(part)
+        elif isinstance(part, shapely.geometry.MultiPolygon):
+            polygons.extend(part.geoms)
+    polygons = list(map(lambda p: shapely.wkb.loads(shapely.wkb.dumps(p, output_dimension=2)), polygons))
+    if len(polygons) == 1:
+        return polygons[0]
+    return shapely.geometry.MultiPolygon(polygons)
+
+
+# The cells of the grid, keyed by tile name (e.g. "32UNQ").  The grid
+# may be plain or xz-compressed GeoJSON.
+def load_grid(filename: Optional[str] = None, name_property: str = 'Name') -> Dict[str, object]:
+    if filename is None:
+        filename = os.environ.get('CLOUDBUSTER_S2GRID', GRID_FILE)
+    if filename.endswith('.xz'):
+        with lzma.open(filename, 'rt') as f:
+            data = json.load(f)
+    else:
+        with open(filename, 'r') as f:
+            data = json.load(f)
+    grid = {}
+    for feature in data.get('features'):
+        name = feature.get('properties').get(name_property)
+        grid[name] = cell_shape(feature.get('geometry'))
+    return grid
+
+
+# The cells of the grid in an STRtree, for repeated lookups
+class GridIndex:
+    __slots__ = ('names', 'shapes', 'positions', 'tree')
+
+    def __init__(self, grid: Dict[str, object]):
+        self.names = list(grid.keys())
+        self.shapes = list(map(lambda name: grid.get(name), self.names))
+        self.positions = dict(map(lambda i: (self.names[i], i), range(len(self.names))))
+        self.tree = shapely.strtree.STRtree(self.shapes)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    # The names of the tiles that intersect the given geometry, in
+    # sorted order
+    def tiles_for(self, geometry) -> List[str]:
+        if hasattr(self.tree, 'query_items'):
+            candidates = self.tree.query_items(geometry)
+        else:
+            candidates = self.tree.query(geometry)
+        return sorted(filter(lambda name: self.geometry_for(name).intersects(geometry),
+                             map(lambda i: self.names[int(i)], candidates)))
+
+    # The geometry of the named tile
+    def geometry_for(self, tile: str):
+        i = self.positions.get(tile)
+        if i is None:
+            raise KeyError('no such tile: {}'.format(tile))
+        return self.shapes[i]
+
+
+# Write the grid as an xz-compressed sequence of (name, WKB) records
+# after a short header.  Reading it back is much quicker than parsing
+# the GeoJSON.
+def write_index(grid: Dict[str, object], filename: str) -> None:
+    with lzma.open(filename, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack('<I', len(grid)))
+        for (name, shape) in grid.items():
+            name_bytes = name.encode()
+            wkb_bytes = shapely.wkb.dumps(shape)
+            f.write(struct.pack('<BI', len(name_bytes), len(wkb_bytes)))
+            f.write(name_bytes)
+            f.write(wkb_bytes)
+
+
+def read_index(filename: str) -> 'GridIndex':
+    with lzma.open(filename, 'rb') as f:
+        data = f.read()
+    if data[0:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError('not a grid index: {}'.format(filename))
+    offset = len(INDEX_MAGIC)
+    (count,) = struct.unpack_from('<I', data, offset)
+    offset += 4
+    grid = {}
+    for _ in range(count):
+        (name_length, wkb_length) = struct.unpack_from('<BI', data, offset)
+        offset += 5
+        name = data[offset:offset+name_length].decode()
+        offset += name_length
+        grid[name] = shapely.wkb.loads(data[offset:offset+wkb_length])
+        offset += wkb_length
+    return GridIndex(grid)
+
+
+# The index of the grid.  Prebuilt indices are read directly; GeoJSON
+# grids are parsed and indexed.  By default the bundled index is used
+# (or the bundled grid if the index has not been built).  Indices are
+# only loaded once per process.
+def load_index(filename: Optional[str] = None, name_property: str = 'Name') -> 'GridIndex':
+    if filename is None:
+        filename = os.environ.get('CLOUDBUSTER_S2GRID')
+    if filename is None:
+        filename = INDEX_FILE if os.path.exists(INDEX_FILE) else GRID_FILE
+    index = INDICES.get(filename)
+    if index is None:
+        if filename.endswith('.index.xz'):
+            index = read_index(filename)
+        else:
+            index = GridIndex(load_grid(filename, name_property))
+        INDICES[filename] = index
+    return index
+
+
+# The names of the tiles that intersect the given geometry, in sorted
+# order
+def tiles_for(geometry, grid: Dict[str, object]) -> List[str]:
+    return GridIndex(grid).tiles_for(geometry)
+
+
+# The UTM zone, latitude band and grid square of a tile name
+def tile_parts(name: str) -> dict:
+    match = re.match(r'^(\d{1,2})([C-X])([A-Z]{2})$', name)
+    if match is None:
+        raise ValueError('not a Sentinel-2 tile: {}'.format(name))
+    return {
+        'utm_zone': int(match.group(1)),
+        'latitude_band': match.group(2),
+        'grid_square': match.group(3),
+    }
+
+
+def cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', required=False, type=str, default=GRID_FILE,
+                        help='The Sentinel-2 grid (GeoJSON, possibly xz-compressed)')
+    parser.add_argument('--name-property', required=False, type=str, default='Name',
+                        help='The property that names the grid cells')
+    parser.add_argument('--output', required=False, type=str, default=INDEX_FILE,
+                        help='Where to write the index')
+    return parser
+
+
+if __name__ == '__main__':
+    args = cli_parser().parse_args()
+
+    grid = load_grid(args.grid, args.name_property)
+    print('{} cells'.format(len(grid)))
+    write_index(grid, args.output)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import shapely.geometry  # type: ignore
+import shapely.wkb  # type: ignore
+
+CHUNK_SIZE = 1 << 20
+
+
+# A compact record of one result of a query.  The footprint is kept as
+# WKB and only turned into a shapely geometry when it is needed.  Any
+# fields of the result that are not known here are kept in `extra` so
+# that results survive the trip through a Scene unchanged.  So are the
+# original forms of values that would not (integer percentages, which
+# would come back as floats, and footprints that WKB would change, such
+# as those with integer coordinates); the percentages are used for as
+# long as the record still holds the same values.
+class Scene:
+    __slots__ = ('name', 'path', 'created_at', 'cloudy', 'aoi_cloudy',
+                 'footprint', 'extra', '_shape')
+
+    def __init__(self,
+                 name: str,
+                 path: str,
+                 created_at: str,
+                 cloudy: float,
+                 footprint: bytes,
+                 aoi_cloudy: Optional[float] = None,
+                 extra: Optional[dict] = None):
+        self.name = name
+        self.path = path
+        self.created_at = created_at
+        self.cloudy = cloudy
+        self.aoi_cloudy = aoi_cloudy
+        self.footprint = footprint
+        self.extra = extra
+        self._shape = None
+
+    @classmethod
+    def from_result(cls, result: dict) -> 'Scene':
+        result = dict(result)
+        metadata = dict(result.pop('sceneMetadata'))
+        footprint = result.pop('dataFootprint')
+        cloudy = metadata.pop('cloudyPixelPercentage')
+        aoi_cloudy = metadata.pop('aoiCloudyPixelPercentage', None)
+        shape = shapely.geometry.shape(footprint)
+        scene = cls(name=result.pop('name'),
+                    path=metadata.pop('path'),
+                    created_at=result.pop('createdAt'),
+                    cloudy=float(cloudy),
+                    footprint=shapely.wkb.dumps(shape),
+                    aoi_cloudy=float(aoi_cloudy) if aoi_cloudy is not None else None)
+        exact = originals(footprint, shape, cloudy, aoi_cloudy)
+        if len(result) > 0 or len(metadata) > 0 or len(exact) > 0:
+            scene.extra = {'result': result, 'sceneMetadata': metadata, 'exact': exact}
+        return scene
+
+    # A Scene from a STAC item (as returned by Earth Search)
+    @classmethod
+    def from_item(cls, item: dict) -> 'Scene':
+        tiles = item.get('assets').get('B01').get('href')
+        tiles = tiles[tiles.find('/tiles') + 1:]  # get "/tiles/..."
+        tiles = tiles[:-8]  # remove "/B01.jp2" from the end
+        if tiles.endswith('/R60m'):
+            tiles = tiles[:-5]
+        properties = item.get('properties')
+        shape = shapely.geometry.shape(item.get('geometry'))
+        scene = cls(name=properties.get('sentinel:product_id'),
+                    path=tiles,
+                    created_at=properties.get('datetime'),
+                    cloudy=float(properties.get('eo:cloud_cover')),
+                    footprint=shapely.wkb.dumps(shape))
+        exact = originals(item.get('geometry'), shape, properties.get('eo:cloud_cover'))
+        if len(exact) > 0:
+            scene.extra = {'result': {}, 'sceneMetadata': {}, 'exact': exact}
+        return scene
+
+    def to_result(self) -> dict:
+        metadata = {
+            'cloudyPixelPercentage': self.cloudy,
+            'path': self.path,
+        }
+        if self.aoi_cloudy is not None:
+            metadata['aoiCloudyPixelPercentage'] = self.aoi_cloudy
+        result = {
+            'dataFootprint': shapely.geometry.mapping(self.shape),
+            'createdAt': self.created_at,
+            'name': self.name,
+            'sceneMetadata': metadata,
+        }
+        if self.extra is not None:
+            metadata.update(self.extra.get('sceneMetadata'))
+            result.update(self.extra.get('result'))
+            exact = self.extra.get('exact', {})
+            for key in ['cloudyPixelPercentage', 'aoiCloudyPixelPercentage']:
+                if key in exact and metadata.get(key) == exact.get(key):
+                    metadata[key] = exact.get(key)
+            if 'dataFootprint' in exact:
+                result['dataFootprint'] = exact.get('dataFootprint')
+        return result
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._shape = shapely.wkb.loads(self.footprint)
+        return self._shape
+
+    # The cloud percentage over the AOI if it has been estimated (see
+    # local_clouds.py), otherwise that of the whole scene
+    def cloudy_pixel_percentage(self) -> float:
+        if self.aoi_cloudy is not None:
+            return self.aoi_cloudy
+        return self.cloudy
+
+
+# The original forms of the values of a result that a Scene would not
+# reproduce exactly
+def originals(footprint: dict, shape, cloudy, aoi_cloudy=None) -> dict:
+    exact = {}
+    if not isinstance(cloudy, float):
+        exact['cloudyPixelPercentage'] = cloudy
+    if aoi_cloudy is not None and not isinstance(aoi_cloudy, float):
+        exact['aoiCloudyPixelPercentage'] = aoi_cloudy
+    if json.dumps(shapely.geometry.mapping(shape), sort_keys=True) != json.dumps(footprint, sort_keys=True):
+        exact['dataFootprint'] = footprint
+    return exact
+
+
+# A forward-only reader of JSON text that decodes one value at a time
+# from a buffer that is refilled from the file as needed
+class JsonStream:
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    # Read at least as much again as is buffered, so that a large value
+    # is decoded a logarithmic number of times
+    def fill(self):
+        chunk = self.f.read(max(CHUNK_SIZE, len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if chunk == '':
+            self.eof = True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def expect(self, c: str):
+        if self.peek() != c:
+            raise ValueError('expected {} at {}'.format(repr(c), repr(self.buffer[self.pos:self.pos + 32])))
+        self.pos += 1
+
+    # A value that ends exactly at the end of the buffer (a number, for
+    # instance) might continue in the file, so it is only accepted once
+    # more has been read or the file is exhausted.
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+# Stream the members of a response file as (key, value) pairs.  The
+# results are produced one at a time as ('results', result) pairs, so
+# that the whole response is never held in memory as nested
+# dictionaries.
+def iter_response(filename: str) -> Iterator[Tuple[str, object]]:
+    with open(filename, 'r') as f:
+        stream = JsonStream(f)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'results':
+                stream.expect('[')
+                while stream.peek() != ']':
+                    yield (key, stream.value())
+                    if stream.peek() == ',':
+                        stream.expect(',')
+                stream.expect(']')
+            else:
+                yield (key, stream.value())
+            if stream.peek() != ',':
+                break
+            stream.expect(',')
+        stream.expect('}')
+
+
+# Read a response file, returning its other members and its results as
+# Scenes
+def read_response(filename: str) -> Tuple[dict, List[Scene]]:
+    header = {}
+    scenes = []
+    for (key, value) in iter_response(filename):
+        if key == 'results':
+            scenes.append(Scene.from_result(value))
+        else:
+            header[key] = value
+    return header, scenes
+
+
+# Write a response file one result at a time.  The output is the same as
+# that of json.dump(..., sort_keys=True, indent=4).
+def write_response(filename: str, header: dict, scenes: Iterable[Scene]):
+    def dumps(value, indent):
+        text = json.dumps(value, sort_keys=True, indent=4, separators=(',', ': '))
+        return text.replace('\n', '\n' + ' ' * indent)
+
+    keys = sorted(set(header.keys()) | set(['results']))
+    with open(filename, 'w') as f:
+        f.write('{\n')
+        for (k, key) in enumerate(keys):
+            f.write('    {}: '.format(json.dumps(key)))
+            if key == 'results':
+                count = 0
+                for scene in scenes:
+                    f.write('[\n' if count == 0 else ',\n')
+                    f.write(' ' * 8 + dumps(scene.to_result(), 8))
+                    count += 1
+                f.write('[]' if count == 0 else '\n    ]')
+            else:
+                f.write(dumps(header.get(key), 4))
+            f.write(',\n' if k < len(keys) - 1 else '\n')
+        f.write('}')
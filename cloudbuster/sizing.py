@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import math
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+# Models of the peak memory (in MB) and CPU use of gather and merge
+# jobs.  A gather holds every band of a whole tile (10980×10980 pixels
+# at 10m) in memory as uint16s, plus a mask and a band being read; with
+# inference, a float32 copy of the mask and the model.  A merge holds
+# a block of each input, the read caches and the output blocks.  The
+# models are deliberately generous; records of previous runs (see
+# `read_metrics`) are used to correct them.
+
+TILE_PIXELS = 10980 * 10980
+BANDS = {'L1C': 14, 'L2A': 13}
+BLOCK_PIXELS = 512 * 512
+METER = 1.0 / 110000  # in degrees, roughly
+MB = float(1 << 20)
+
+GATHER_BASE = 1500.0
+INFERENCE_BASE = 2000.0
+MERGE_BASE = 1000.0
+
+# Containers are padded by this much over the (corrected) estimate and
+# rounded up to a multiple of MEMORY_STEP
+MARGIN = 1.2
+MEMORY_STEP = 256
+MEMORY_MIN = 1024
+
+# The overhead (in seconds) of a job that its gathers can not see from
+# inside their process: scheduling, starting the container and the
+# bootstrap of download_run.sh.  Selections are packed into jobs so
+# that the overhead is at most PACK_OVERHEAD of each job, and no job
+# runs for longer than PACK_SECONDS.
+JOB_OVERHEAD = 60.0
+PACK_OVERHEAD = 0.1
+PACK_SECONDS = 3600.0
+
+
+def gather_model(kind: str = 'L1C', inference: bool = False, window_pixels: int = 0) -> Tuple[float, int]:
+    bands = BANDS.get(kind, 14)
+    memory = GATHER_BASE + TILE_PIXELS * (2 * bands + 4) / MB + window_pixels * 2 * bands / MB / 16
+    vcpus = 2
+    if inference:
+        memory += INFERENCE_BASE + TILE_PIXELS * 4 / MB
+        vcpus = 4
+    return (memory, vcpus)
+
+
+def merge_model(inputs: int = 16, window_pixels: int = 0, cache_size: int = 256,
+                cog: bool = False, bands: int = 14) -> Tuple[float, int]:
+    # The read caches are shared by all of the open inputs (see merge),
+    # so `cache_size` bounds them together
+    memory = MERGE_BASE + cache_size + inputs * BLOCK_PIXELS * 2 * bands / MB
+    # Each row of output blocks (and, for COGs, of overview blocks) is
+    # held until it is written
+    row_pixels = BLOCK_PIXELS * max(1, int(math.sqrt(max(window_pixels, 1)) / 512))
+    memory += 2 * row_pixels * 2 * bands / MB * (2 if cog else 1)
+    vcpus = 2 if inputs <= 16 else 4
+    return (memory, vcpus)
+
+
+# The number of pixels that the given bounds cover on the given grid
+# (or at 10m)
+def window_pixels(bounds: Optional[List[float]], grid: Optional[List[float]] = None, shards: int = 1) -> int:
+    if bounds is None:
+        return TILE_PIXELS
+    [xmin, ymin, xmax, ymax] = bounds
+    if grid is not None:
+        [xres, yres] = [abs(grid[2]), abs(grid[3])]
+    else:
+        xres = yres = 10 * METER
+    return int(math.ceil((xmax - xmin) / xres) * math.ceil((ymax - ymin) / yres) / shards)
+
+
+# The model's estimate for a recorded run
+def modeled(record: dict) -> Tuple[float, int]:
+    if record.get('job') == 'gather':
+        return gather_model(record.get('kind'), record.get('inference'), record.get('window_pixels'))
+    return merge_model(record.get('inputs'), record.get('window_pixels'), record.get('cache_size', 256),
+                       record.get('cog'), record.get('bands', 14))
+
+
+# The value below which the given fraction of the values lie
+def quantile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+# Corrections to the model from recorded runs of a kind of job (and
+# with the given properties): the factor by which the model
+# underestimates peak memory and the number of CPUs that the jobs kept
+# busy (the 90th percentiles of each).
+def calibrate(records: List[dict], job: str, **properties) -> Dict[str, float]:
+    records = list(filter(lambda r: r.get('job') == job and r.get('peak_rss') and
+                          all(map(lambda k: r.get(k) == properties.get(k), properties.keys())), records))
+    if len(records) == 0:
+        return {}
+    ratios = list(map(lambda r: r.get('peak_rss') / modeled(r)[0], records))
+    busy = list(map(lambda r: r.get('cpu_seconds') / max(r.get('wall_seconds'), 1e-3), records))
+    return {
+        'memory': quantile(ratios, 0.9),
+        'vcpus': quantile(busy, 0.9),
+        'runs': len(records),
+    }
+
+
+# Container overrides (vCPUs and MB) for an estimate, corrected by a
+# calibration if there is one
+def container(estimate: Tuple[float, int], calibration: Dict[str, float]) -> Tuple[int, int]:
+    (memory, vcpus) = estimate
+    if 'memory' in calibration:
+        memory = memory * calibration.get('memory')
+    if 'vcpus' in calibration:
+        vcpus = max(1, int(math.ceil(calibration.get('vcpus'))))
+    memory = max(MEMORY_MIN, int(math.ceil(memory * MARGIN / MEMORY_STEP)) * MEMORY_STEP)
+    return (vcpus, memory)
+
+
+# Runs with and without inference use CPUs very differently, so the
+# CPUs of one are not calibrated from the other (but their memory
+# may be)
+def gather_resources(kind: str = 'L1C', inference: bool = False, window: int = 0,
+                     records: Optional[List[dict]] = None) -> Tuple[int, int]:
+    calibration = calibrate(records or [], 'gather', inference=inference)
+    if len(calibration) == 0:
+        calibration = calibrate(records or [], 'gather')
+        calibration.pop('vcpus', None)
+    return container(gather_model(kind, inference, window), calibration)
+
+
+def merge_resources(inputs: int = 16, window: int = 0, cache_size: int = 256, cog: bool = False,
+                    kind: str = 'L1C', records: Optional[List[dict]] = None) -> Tuple[int, int]:
+    return container(merge_model(inputs, window, cache_size, cog, BANDS.get(kind, 14)),
+                     calibrate(records or [], 'merge'))
+
+
+# The overhead of a gather job and the work of each gather in it (in
+# seconds), from the records of earlier gathers with the given
+# properties.  The overhead seen from inside the process is the time
+# that the first gather of each process waited to start plus the time
+# that it took to load its model (which later gathers in the process
+# reuse); the work is the rest of the time of each gather.  None if
+# there are no records.
+def gather_timings(records: List[dict], job_overhead: float = JOB_OVERHEAD,
+                   **properties) -> Optional[Tuple[float, float]]:
+    records = list(filter(lambda r: r.get('job') == 'gather' and r.get('wall_seconds') is not None and
+                          all(map(lambda k: r.get(k) == properties.get(k), properties.keys())), records))
+    if len(records) == 0:
+        return None
+    firsts = list(filter(lambda r: r.get('startup_seconds') is not None, records))
+    overheads = list(map(lambda r: r.get('startup_seconds') + r.get('model_seconds', 0.0), firsts))
+    works = list(map(lambda r: r.get('wall_seconds') - r.get('model_seconds', 0.0), records))
+    overhead = job_overhead + (quantile(overheads, 0.5) if len(overheads) > 0 else 0.0)
+    return (overhead, quantile(works, 0.5))
+
+
+# The number of selections to gather one after another in each job:
+# the fewest for which the overhead of the job is at most `fraction`
+# of it, but no more than fit in `max_seconds`.  Packing breaks even
+# once the overhead of a job is comparable with the work of a gather;
+# past that, it cuts the time spent on overhead by a factor of the
+# size of the packs.
+def pack_size(overhead: float, work: float, fraction: float = PACK_OVERHEAD,
+              max_seconds: float = PACK_SECONDS) -> int:
+    work = max(work, 1.0)
+    pack = int(math.ceil(overhead * (1.0 - fraction) / (fraction * work)))
+    return max(1, min(pack, int(max_seconds // work)))
+
+
+# Without records of earlier gathers, selections are not packed
+def gather_pack(kind: str = 'L1C', inference: bool = False,
+                records: Optional[List[dict]] = None) -> int:
+    timings = gather_timings(records or [], kind=kind, inference=inference)
+    if timings is None:
+        return 1
+    return pack_size(*timings)
+
+
+# The records left by gathers and merges under a local directory or S3
+# prefix (see the `metrics` arguments of `gather` and `merge`)
+def read_metrics(uri: Optional[str]) -> List[dict]:
+    if uri is None:
+        return []
+    records = []
+    parsed = urlparse(uri)
+    if parsed.scheme == 's3':
+        import boto3
+        s3 = boto3.client('s3')
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=parsed.netloc, Prefix=parsed.path.lstrip('/')):
+            for obj in page.get('Contents', []):
+                if obj.get('Key').endswith('.json'):
+                    body = s3.get_object(Bucket=parsed.netloc, Key=obj.get('Key')).get('Body')
+                    records.append(json.loads(body.read()))
+    elif os.path.isdir(uri):
+        for filename in sorted(os.listdir(uri)):
+            if filename.endswith('.json'):
+                with open(os.path.join(uri, filename), 'r') as f:
+                    records.append(json.load(f))
+    return records
+
+
+# Copy a file to or from S3.  When neither location is on S3 (for
+# instance when a local directory stands in for a bucket), the file is
+# copied directly.
+def copy_uri(src: str, dst: str) -> int:
+    if src.startswith('s3://') or dst.startswith('s3://'):
+        return os.system('aws s3 cp {} {}'.format(src, dst))
+    if not os.path.isfile(src):
+        return 1
+    if dst.endswith('/'):
+        os.makedirs(dst, exist_ok=True)
+    shutil.copy(src, dst)
+    return 0
+
+
+# The wall-clock time and the CPU time used by this process and its
+# children (the AWS CLI and GDAL utilities) so far
+def usage() -> Tuple[float, float]:
+    import resource
+    cpu = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        r = resource.getrusage(who)
+        cpu += r.ru_utime + r.ru_stime
+    return (time.time(), cpu)
+
+
+# Save a record of the resources that a job used (its peak memory in
+# MB, that of this process or of the largest of its children, and its
+# CPU and wall-clock time since `start`) along with the properties of
+# the job under `uri`, where `read_metrics` finds it
+def record_metrics(uri: str, filename: str, start: Tuple[float, float], record: dict) -> None:
+    import resource
+    (wall, cpu) = usage()
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    record.update({
+        'peak_rss': peak / 1024.0,
+        'cpu_seconds': cpu - start[1],
+        'wall_seconds': wall - start[0],
+    })
+    with open(filename, 'w') as f:
+        json.dump(record, f, sort_keys=True, indent=4, separators=(',', ': '))
+    copy_uri(filename, uri if uri.endswith('/') else uri + '/')
+    os.remove(filename)
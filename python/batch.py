@@ -0,0 +1 @@
+../cloudbuster/batch.py
\ No newline at end of file
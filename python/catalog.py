@@ -0,0 +1 @@
+../cloudbuster/catalog.py
\ No newline at end of file
@@ -0,0 +1 @@
+../cloudbuster/dedup.py
\ No newline at end of file
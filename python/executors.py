@@ -0,0 +1 @@
+../cloudbuster/executors.py
\ No newline at end of file
@@ -0,0 +1 @@
+../cloudbuster/filter_batch.py
\ No newline at end of file
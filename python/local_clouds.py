@@ -0,0 +1 @@
+../cloudbuster/local_clouds.py
\ No newline at end of file
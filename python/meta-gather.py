@@ -29,7 +29,7 @@
 import argparse
 import ast
 import json
-import os
+import sys
 
 
 def cli_parser() -> argparse.ArgumentParser:
@@ -39,12 +39,14 @@ def cli_parser() -> argparse.ArgumentParser:
                         default=True, type=ast.literal_eval)
     parser.add_argument('--dryrun', required=False,
                         default=False, type=ast.literal_eval)
-    parser.add_argument('--gather', required=True, type=str)
-    parser.add_argument('--jobdef', required=True, type=str)
-    parser.add_argument('--jobqueue', required=True, type=str)
+    parser.add_argument('--gather', required=False, type=str)
+    parser.add_argument('--jobdef', required=False, type=str)
+    parser.add_argument('--jobqueue', required=False, type=str)
     parser.add_argument('--name', required=True, type=str)
     parser.add_argument('--output-path', required=True, type=str)
-    parser.add_argument('--response', required=True, type=str)
+    parser.add_argument('--response', required=False, type=str)
+    parser.add_argument('--plan', required=False, type=str,
+                        help='Gather the scenes shared by several AOIs once each, according to a plan from dedup.py')
     parser.add_argument('--weights', required=False, type=str)
     parser.add_argument('--index-start', required=False, default=1, type=int)
     parser.add_argument('--kind', required=False,
@@ -57,44 +59,117 @@ def cli_parser() -> argparse.ArgumentParser:
                         default=None, type=str)
     parser.set_defaults(s2cloudless=False)
     parser.add_argument('--tmp', required=False, type=str, default='/tmp')
+    parser.add_argument('--cog', required=False,
+                        default=False, type=ast.literal_eval)
+    parser.add_argument('--grid-align', required=False,
+                        default=True, type=ast.literal_eval)
+    parser.add_argument('--manifest', required=False, type=str,
+                        help='Where to put the manifest of the array job (by default OUTPUT_PATH/NAME-gather-manifest.json)')
+    parser.add_argument('--executor', required=False,
+                        choices=['batch', 'local'], default='batch')
+    parser.add_argument('--workers', required=False, type=int,
+                        help='The most gathers to run at once with the local executor')
+    parser.add_argument('--metrics', required=False, type=str,
+                        help='Where gathers record the resources that they used, from which they are sized')
+    parser.add_argument('--vcpus', required=False, type=int,
+                        help='The CPUs of each gather (by default estimated)')
+    parser.add_argument('--memory', required=False, type=int,
+                        help='The memory (in MB) of each gather (by default estimated)')
+    parser.add_argument('--pack', required=False, type=int,
+                        help='The number of selections that each Batch job gathers in sequence (by default estimated)')
     return parser
 
 
 if __name__ == '__main__':
-    args = cli_parser().parse_args()
+    # The modules sit next to this script; importing them through the
+    # cloudbuster package would pull in gather and torch
+    try:
+        from executors import BatchExecutor, LocalExecutor, gather_job  # type: ignore
+        from sizing import gather_timings, read_metrics  # type: ignore
+    except ImportError:
+        from cloudbuster.executors import BatchExecutor, LocalExecutor, gather_job
+        from cloudbuster.sizing import gather_timings, read_metrics
+
+    parser = cli_parser()
+    args = parser.parse_args()
+
+    if args.executor == 'batch' and None in [args.gather, args.jobdef, args.jobqueue]:
+        parser.error('--gather, --jobdef, and --jobqueue are required with batch')
+    if (args.response is None) == (args.plan is None):
+        parser.error('exactly one of --response and --plan is required')
+
+    # Each child of the array job finds its selection in the manifest.
+    # The selections of a plan carry their own bounds and grids.
+    entries = []
+    if args.plan is not None:
+        with open(args.plan, 'r') as f:
+            plan = json.load(f)
+        if args.name != plan.get('name'):
+            parser.error('--name must be that of the plan ({})'.format(plan.get('name')))
+        entries = plan.get('gathers')
+        for entry in entries:
+            if not args.bounds_clip:
+                del entry['bounds']
+            if not args.grid_align:
+                del entry['grid']
+        bounds = grid = None
+    else:
+        with open(args.response, 'r') as f:
+            response = json.load(f)
+        bounds = response.get('bounds') if args.bounds_clip else None
+        grid = response.get('grid') if args.grid_align else None
+        results = response.get('selections')
+        idxs = range(args.index_start, len(results)+args.index_start)
+        for (i, result) in zip(idxs, results):
+            entries.append({
+                'backstop': result.get('backstop', False),
+                'index': i,
+                'sentinel_path': result.get('sceneMetadata').get('path'),
+            })
+
+    if len(entries) == 0:
+        print('no selections')
+        sys.exit(0)
+
+    job = gather_job(args.name,
+                     args.output_path,
+                     entries,
+                     gather=args.gather,
+                     manifest=args.manifest,
+                     bounds=bounds,
+                     grid=grid,
+                     architecture=args.architecture,
+                     weights=args.weights,
+                     kind=args.kind,
+                     donate_mask=args.donate_mask,
+                     donor_mask=args.donor_mask,
+                     donor_mask_name=args.donor_mask_name,
+                     cog=args.cog,
+                     tmp=args.tmp,
+                     metrics=args.metrics,
+                     vcpus=args.vcpus,
+                     memory=args.memory,
+                     pack=args.pack)
+    print('{} vCPUs, {} MB per gather'.format(job.vcpus, job.memory))
+    if args.executor == 'batch':
+        # The break-even point of packing is where the overhead of a
+        # job matches the work of one gather
+        if args.metrics is not None:
+            inference = args.architecture is not None and args.weights is not None and args.donor_mask is None
+            timings = gather_timings(read_metrics(args.metrics), kind=args.kind, inference=inference)
+            if timings is not None:
+                print('{:.0f} seconds of overhead per job, {:.0f} seconds per gather'.format(*timings))
+        print('{} gathers per job, {} jobs'.format(job.pack, -(-len(entries) // job.pack)))
 
-    with open(args.response, 'r') as f:
-        response = json.load(f)
-    [xmin, ymin, xmax, ymax] = response.get('bounds')
-    results = response.get('selections')
+    if args.executor == 'local':
+        executor = LocalExecutor(vcpus=job.vcpus, memory=job.memory, workers=args.workers,
+                                 scratch_root=args.tmp, dryrun=args.dryrun)
+    else:
+        executor = BatchExecutor(args.jobqueue, args.jobdef, dryrun=args.dryrun)
+    codes = executor.wait(executor.submit(job))
+    executor.shutdown()
 
-    idxs = range(args.index_start, len(results)+args.index_start)
-    for (i, result) in zip(idxs, results):
-        submission = ''.join([
-            'aws batch submit-job ',
-            '--job-name {} '.format('{}-{}'.format(args.name, i)),
-            '--job-queue {} '.format(args.jobqueue),
-            '--job-definition {} '.format(args.jobdef),
-            '--container-overrides vcpus=2,memory=15000,',
-            'command=./download_run.sh,{},'.format(args.gather),
-            '--name,{},'.format(args.name),
-            '--index,{},'.format(i),
-            '--output-path,{},'.format(args.output_path),
-            '--sentinel-path,{},'.format(
-                result.get('sceneMetadata').get('path')),
-            '--architecture,{},'.format(
-                args.architecture) if args.architecture is not None else '',
-            '--weights,{},'.format(args.weights) if args.weights is not None else '',
-            '--bounds,{},{},{},{},'.format(xmin, ymin,
-                                           xmax, ymax) if args.bounds_clip else '',
-            '--kind,{},'.format(args.kind),
-            '--donor-mask,{},'.format(args.donor_mask),
-            '--donor-mask-name,{},'.format(args.donor_mask_name),
-            '--donate-mask,{},'.format(args.donate_mask),
-            '--tmp,{},'.format(args.tmp),
-            '--backstop,{}'.format(result.get('backstop', False)),
-        ])
-        if args.dryrun:
-            print(submission)
-        else:
-            os.system(submission)
+    failures = len(list(filter(any, codes)))
+    if failures > 0:
+        print('{} of {} gathers failed'.format(failures, len(entries)))
+        sys.exit(-1)
@@ -29,7 +29,6 @@
 import argparse
 import ast
 import json
-import os
 
 
 def cli_parser() -> argparse.ArgumentParser:
@@ -37,32 +36,86 @@ def cli_parser() -> argparse.ArgumentParser:
     parser.add_argument('--dryrun', required=False,
                         default=False, type=ast.literal_eval)
     parser.add_argument('--input-path', required=True, type=str)
-    parser.add_argument('--jobdef', required=True, type=str)
-    parser.add_argument('--jobqueue', required=True, type=str)
-    parser.add_argument('--merge', required=True, type=str)
+    parser.add_argument('--jobdef', required=False, type=str)
+    parser.add_argument('--jobqueue', required=False, type=str)
+    parser.add_argument('--merge', required=False, type=str)
     parser.add_argument('--name', required=True, type=str)
     parser.add_argument('--output-path', required=True, type=str)
     parser.add_argument('--tmp', required=False, default='/tmp', type=str)
+    parser.add_argument('--shards', required=False, default=1, type=int)
+    parser.add_argument('--bounds', required=False, nargs='+', type=float)
+    parser.add_argument('--response', required=False, type=str)
+    parser.add_argument('--assemble-format', required=False,
+                        choices=['vrt', 'cog'], default='vrt')
+    parser.add_argument('--executor', required=False,
+                        choices=['batch', 'local'], default='batch')
+    parser.add_argument('--workers', required=False, type=int)
+    parser.add_argument('--cog', required=False,
+                        default=False, type=ast.literal_eval)
+    parser.add_argument('--vrt', required=False,
+                        default=False, type=ast.literal_eval)
+    parser.add_argument('--metrics', required=False, type=str,
+                        help='Where merges record the resources that they used, from which they are sized')
+    parser.add_argument('--vcpus', required=False, type=int,
+                        help='The CPUs of each merge (by default estimated)')
+    parser.add_argument('--memory', required=False, type=int,
+                        help='The memory (in MB) of each merge (by default estimated)')
     return parser
 
 
 if __name__ == '__main__':
-    args = cli_parser().parse_args()
+    # The modules sit next to this script; importing them through the
+    # cloudbuster package would pull in gather and torch
+    try:
+        from executors import BatchExecutor, LocalExecutor, merge_jobs, submit_chain  # type: ignore
+    except ImportError:
+        from cloudbuster.executors import BatchExecutor, LocalExecutor, merge_jobs, submit_chain
+
+    parser = cli_parser()
+    args = parser.parse_args()
+
+    if args.bounds is None and args.response is not None:
+        with open(args.response, 'r') as f:
+            args.bounds = json.load(f).get('bounds')
+    if args.shards > 1 and args.bounds is None:
+        parser.error('--bounds or --response is required when sharding')
+    if args.executor == 'batch' and None in [args.jobdef, args.jobqueue, args.merge]:
+        parser.error('--jobdef, --jobqueue, and --merge are required with batch')
 
-    jobname = '{}-MERGE'.format(args.name)
-    submission = ''.join([
-        'aws batch submit-job ',
-        '--job-name {} '.format(jobname),
-        '--job-queue {} '.format(args.jobqueue),
-        '--job-definition {} '.format(args.jobdef),
-        '--container-overrides vcpus=8,memory=15000,',
-        'command=./download_run.sh,{},'.format(args.merge),
-        '--input-path,{},'.format(args.input_path),
-        '--name,{},'.format(args.name),
-        '--output-path,{}'.format(args.output_path),
-        '--tmp,{}'.format(args.tmp)
-    ])
-    if args.dryrun:
-        print(submission)
+    # The number of inputs, for sizing the merge
+    inputs = None
+    if args.vcpus is None or args.memory is None:
+        try:
+            from merge import list_sources  # type: ignore
+        except ImportError:
+            from cloudbuster.merge import list_sources
+        inputs = len(list_sources(args.input_path))
+
+    jobs = merge_jobs(args.name,
+                      args.input_path,
+                      args.output_path,
+                      merge=args.merge,
+                      bounds=args.bounds,
+                      shards=args.shards,
+                      assemble_format=args.assemble_format,
+                      cog=args.cog,
+                      vrt=args.vrt,
+                      tmp=args.tmp,
+                      inputs=inputs,
+                      metrics=args.metrics,
+                      vcpus=args.vcpus,
+                      memory=args.memory)
+    print('{} vCPUs, {} MB per merge'.format(jobs[0].vcpus, jobs[0].memory))
+
+    # Workers must fit both the shards and the assembly (if any)
+    if args.executor == 'local':
+        executor = LocalExecutor(vcpus=max(map(lambda job: job.vcpus, jobs)),
+                                 memory=max(map(lambda job: job.memory, jobs)),
+                                 workers=args.workers,
+                                 scratch_root=args.tmp, dryrun=args.dryrun)
     else:
-        os.system(submission)
+        executor = BatchExecutor(args.jobqueue, args.jobdef, dryrun=args.dryrun)
+
+    # The shards are stitched together once they have all finished
+    executor.wait(submit_chain(executor, jobs))
+    executor.shutdown()
@@ -0,0 +1 @@
+../cloudbuster/pipeline.py
\ No newline at end of file
@@ -30,14 +30,22 @@ import argparse
 import copy
 import gzip
 import json
+import os
+import sys
 
 import shapely.geometry
 import shapely.ops
 
+# s2grid sits in python/, one level up; importing it through the
+# cloudbuster package would pull in all of that package's dependencies
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from s2grid import load_index  # type: ignore # noqa: E402
+
 # Given a GeoJSON file covering the interesting part of the world, a
 # GeoJSON file containing some division of the world, and the
-# Sentinel-2 grid as a GeoJSON file, generate a list of tiles that
-# covers each intersection of the members of the first two.
+# Sentinel-2 grid (by default the bundled index of it), generate a
+# list of tiles that covers each intersection of the members of the
+# first two.
 
 
 def cli_parser() -> argparse.ArgumentParser:
@@ -52,8 +60,8 @@ def cli_parser() -> argparse.ArgumentParser:
                         help='The property that gives the division number')
     parser.add_argument('--number-min', required=False, type=int, default=1)
     parser.add_argument('--number-max', required=False, type=int, default=5)
-    parser.add_argument('--grid-geojson', required=True,
-                        type=str, help='The Sentinel-2 grid')
+    parser.add_argument('--grid-geojson', required=False, default=None,
+                        type=str, help='The Sentinel-2 grid (a prebuilt index or GeoJSON)')
     parser.add_argument('--grid-property', required=False, default='Name',
                         type=str, help='The Sentinel-2 property that names the grid cells')
     return parser
@@ -66,8 +74,6 @@ if __name__ == '__main__':
         world = json.load(f)
     with open(args.number_geojson, 'r') as f:
         number = json.load(f)
-    with open(args.grid_geojson, 'r') as f:
-        grid = json.load(f)
 
     # World
     world_dict = {}
@@ -89,20 +95,12 @@ if __name__ == '__main__':
         number_dict[i] = shapely.ops.cascaded_union(fs).buffer(0)
     del number
 
-    grid_list = []
-    for feature in grid.get('features'):
-        grid_list.append({
-            'name': feature.get('properties').get(args.grid_property),
-            'shape': shapely.geometry.shape(feature.get('geometry'))
-        })
-    del grid
+    grid_index = load_index(args.grid_geojson, args.grid_property)
 
     for (k1, v1) in world_dict.items():
         for (k2, v2) in number_dict.items():
             xsection = v1.intersection(v2)
-            this_list = filter(lambda o: xsection.intersects(
-                o.get('shape')), grid_list)
-            this_list = list(map(lambda o: o.get('name'), this_list))
+            this_list = grid_index.tiles_for(xsection)
             filename = '/tmp/{}_{}.json.gz'.format(k1, k2)
             print(filename)
             with gzip.open(filename, 'w') as f:
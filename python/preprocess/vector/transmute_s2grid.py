@@ -28,16 +28,26 @@
 
 import argparse
 import json
+import os
+import sys
 
 import shapely.geometry
 import shapely.ops
 
+# s2grid sits in python/, two levels up; importing it through the
+# cloudbuster package would pull in all of that package's dependencies
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+from s2grid import GridIndex, cell_shape, load_index  # type: ignore # noqa: E402
+
 
 def cli_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', required=True, type=str)
     parser.add_argument('--filter', required=True, type=str)
     parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--index', required=False, type=str, default=None,
+                        help='An index of the grid (by default the bundled one)')
+    parser.add_argument('--name-property', required=False, type=str, default='Name')
     return parser
 
 
@@ -53,6 +63,20 @@ if __name__ == '__main__':
     with open(args.input, 'r') as f:
         data = json.load(f)
 
+    # Only cells that the index finds can intersect the filter; its
+    # cells include every polygon of the features below, so it cannot
+    # miss any.  An input whose cells are not all in the index is not
+    # that grid, and is indexed itself.
+    grid_index = load_index(args.index, args.name_property)
+    if not all(map(lambda f: f.get('properties').get(args.name_property) in grid_index.positions,
+                   data.get('features'))):
+        grid_index = GridIndex(dict(map(
+            lambda f: (f.get('properties').get(args.name_property), cell_shape(f.get('geometry'))),
+            data.get('features'))))
+    candidates = set(grid_index.tiles_for(filter_geometry))
+    data['features'] = list(filter(
+        lambda f: f.get('properties').get(args.name_property) in candidates, data.get('features')))
+
     # Read features
     for feature in data.get('features'):
         geometry = shapely.geometry.shape(feature.get('geometry'))
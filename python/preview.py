@@ -40,6 +40,8 @@ def cli_parser() -> argparse.ArgumentParser:
 if __name__ == '__main__':
     args = cli_parser().parse_args()
 
-    os.system('aws s3 cp {} /tmp/in.tif'.format(args.input))
-    os.system('gdalwarp /tmp/in.tif -ts 1024 1024 /tmp/out.tif')
+    # Read the input in place so that, if it has overviews, only the
+    # smallest suitable one is fetched
+    input_name = args.input.replace('s3://', '/vsis3/')
+    os.system('gdalwarp {} -ts 1024 1024 /tmp/out.tif'.format(input_name))
     os.system('aws s3 cp /tmp/out.tif {}'.format(args.output))
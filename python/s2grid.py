@@ -0,0 +1 @@
+../cloudbuster/s2grid.py
\ No newline at end of file
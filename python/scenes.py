@@ -0,0 +1 @@
+../cloudbuster/scenes.py
\ No newline at end of file
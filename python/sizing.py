@@ -0,0 +1 @@
+../cloudbuster/sizing.py
\ No newline at end of file
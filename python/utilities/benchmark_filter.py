@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+import sys
+import time
+
+import shapely.affinity  # type: ignore
+import shapely.geometry  # type: ignore
+
+# filter sits in python/, one level up; importing it through the
+# cloudbuster package would pull in all of that package's dependencies
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from filter import filter_response  # type: ignore # noqa: E402
+
+# Generate a synthetic query response (by default 800 scenes, the most
+# that query_rf returns) and time each filter engine on it.  Used
+# locally.
+
+# Synthetic responses (scenes and seed) on which the lazy engine must
+# make the same selections as the exhaustive one.  On the first, two
+# areas of one scene differ only in the last place.
+EQUIVALENCE_CASES = [(60, 5)]
+
+
+def cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenes', required=False, type=int, default=800)
+    parser.add_argument('--seed', required=False, type=int, default=33)
+    parser.add_argument('--coverage-count', required=False, type=int, default=3)
+    parser.add_argument('--engines', required=False, nargs='+',
+                        default=['exhaustive', 'lazy'])
+    parser.add_argument('--raster-resolution', required=False, type=float, default=0.01)
+    parser.add_argument('--response', required=False, type=str,
+                        help='Where to save the synthetic response')
+    return parser
+
+
+# Scenes are roughly the size of Sentinel-2 tiles, scattered around an
+# AOI with holes and an irregular boundary.
+def synthetic_response(scenes: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    aoi = shapely.geometry.Polygon(
+        [(0, 0), (3, 0.2), (3.5, 2.5), (1.5, 3.2), (-0.3, 2)])
+    aoi = aoi.difference(shapely.geometry.Point(1.5, 1.5).buffer(0.3))
+
+    results = []
+    for i in range(scenes):
+        x = rng.uniform(-1.5, 4.0)
+        y = rng.uniform(-1.5, 3.7)
+        footprint = shapely.geometry.box(x, y, x + 1.0, y + 0.9)
+        footprint = footprint.intersection(
+            shapely.affinity.rotate(footprint, rng.uniform(-10, 10)))
+        results.append({
+            'dataFootprint': shapely.geometry.mapping(footprint),
+            'createdAt': '2020-{:02d}-{:02d}T00:00:00Z'.format(
+                rng.randint(1, 12), rng.randint(1, 28)),
+            'name': 'S2A_SYNTHETIC_{:04d}'.format(i),
+            'sceneMetadata': {
+                'cloudyPixelPercentage': rng.uniform(0.0, 60.0),
+                'path': 'tiles/{}/U/{}Q/2020/1/{}/0'.format(
+                    rng.randint(30, 33), rng.choice('ABCD'), i),
+            },
+        })
+
+    return {
+        'aoi': shapely.geometry.mapping(aoi),
+        'results': results,
+    }
+
+
+def run(response: dict, engine: str, coverage_count: int, raster_resolution: float):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start = time.time()
+        selections, _, _ = filter_response(copy.deepcopy(response),
+                                           coverage_count=coverage_count,
+                                           engine=engine,
+                                           raster_resolution=raster_resolution)
+        elapsed = time.time() - start
+    names = list(map(lambda s: s.get('name'), selections.get('selections')))
+    return (names, elapsed, output.getvalue())
+
+
+if __name__ == '__main__':
+    args = cli_parser().parse_args()
+
+    if 'exhaustive' in args.engines and 'lazy' in args.engines:
+        for (scenes, seed) in EQUIVALENCE_CASES:
+            case = synthetic_response(scenes, seed)
+            same = (run(case, 'exhaustive', args.coverage_count, args.raster_resolution)[0] ==
+                    run(case, 'lazy', args.coverage_count, args.raster_resolution)[0])
+            print('{} scenes, seed {}: lazy same as exhaustive: {}'.format(scenes, seed, same))
+
+    response = synthetic_response(args.scenes, args.seed)
+    if args.response is not None:
+        with open(args.response, 'w') as f:
+            json.dump(response, f, sort_keys=True,
+                      indent=4, separators=(',', ': '))
+
+    reference = None
+    for engine in args.engines:
+        (names, elapsed, output) = run(response, engine, args.coverage_count, args.raster_resolution)
+        if reference is None:
+            reference = names
+        ops = list(filter(lambda l: l.startswith('geometry operations'),
+                          output.split('\n')))
+        print('{:>12} {:8.3f}s {:4d} selections, same as {}: {}, {}'.format(
+            engine, elapsed, len(names), args.engines[0], names == reference,
+            ops[0] if len(ops) > 0 else ''))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# =====================
+#
+# Copyright © 2020 Azavea
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the “Software”), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import shapely.geometry  # type: ignore
+
+# A minimal STAC API that serves the results of a saved query response
+# from POST /search, for exercising query_rf locally, e.g.
+#
+#     mock_stac.py --response raw-response.json --port 8000 &
+#     query_rf.py --stac-url http://localhost:8000 ...
+#
+# Searches are filtered by intersection, datetime and properties (e.g.
+# cloud cover or tile id), sorted newest first, and paged by "page" and
+# "limit".  Requests can be delayed and made to fail at random in order
+# to exercise concurrency and retries.
+
+
+def cli_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--response', required=True, type=str)
+    parser.add_argument('--port', required=False, type=int, default=8000)
+    parser.add_argument('--delay', required=False, type=float, default=0.0,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--failure-rate', required=False, type=float, default=0.0,
+                        help='Fraction of requests answered with 503')
+    return parser
+
+
+def item_from_result(result: dict) -> dict:
+    metadata = result.get('sceneMetadata')
+    (_, zone, band, square) = metadata.get('path').split('/')[0:4]
+    return {
+        'type': 'Feature',
+        'id': result.get('name'),
+        'geometry': result.get('dataFootprint'),
+        'properties': {
+            'datetime': result.get('createdAt'),
+            'eo:cloud_cover': metadata.get('cloudyPixelPercentage'),
+            'sentinel:product_id': result.get('name'),
+            'sentinel:utm_zone': int(zone),
+            'sentinel:latitude_band': band,
+            'sentinel:grid_square': square,
+        },
+        'assets': {
+            'B01': {
+                'href': 's3://sentinel-s2-l2a/{}/R60m/B01.jp2'.format(metadata.get('path'))
+            }
+        },
+    }
+
+
+def matches(item: dict, body: dict) -> bool:
+    properties = item.get('properties')
+    if 'intersects' in body:
+        footprint = shapely.geometry.shape(item.get('geometry'))
+        if not footprint.intersects(shapely.geometry.shape(body.get('intersects'))):
+            return False
+    if 'datetime' in body:
+        (start, end) = body.get('datetime').split('/')
+        date = properties.get('datetime')
+        if not (start <= date and date[0:len(end)] <= end):
+            return False
+    for (field, bounds) in body.get('query', {}).items():
+        value = properties.get(field)
+        if 'eq' in bounds and value != bounds.get('eq'):
+            return False
+        if 'gte' in bounds and value < bounds.get('gte'):
+            return False
+        if 'lte' in bounds and value > bounds.get('lte'):
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    args = cli_parser().parse_args()
+
+    with open(args.response, 'r') as f:
+        items = list(map(item_from_result, json.load(f).get('results')))
+    items.sort(key=lambda item: item.get('properties').get('datetime'), reverse=True)
+    lock = threading.Lock()
+    requests = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            with lock:
+                requests[0] += 1
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length'))))
+            time.sleep(args.delay)
+            if self.path.rstrip('/') != '/search':
+                self.send_error(404)
+                return
+            if random.random() < args.failure_rate:
+                self.send_error(503)
+                return
+            limit = int(body.get('limit', 10))
+            page = int(body.get('page', 1))
+            found = list(filter(lambda item: matches(item, body), items))
+            features = found[(page - 1) * limit:page * limit]
+            payload = json.dumps({
+                'type': 'FeatureCollection',
+                'features': features,
+                'context': {
+                    'page': page,
+                    'limit': limit,
+                    'matched': len(found),
+                    'returned': len(features),
+                },
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/geo+json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', args.port), Handler)
+    print('{} items on port {}'.format(len(items), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('{} requests'.format(requests[0]))
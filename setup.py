@@ -8,5 +8,6 @@ setup(name='cloudbuster',
       author_email='[email protected]',
       license='MIT',
       packages=['cloudbuster'],
-      scripts=['cloudbuster/query_rf.py', 'cloudbuster/filter.py', 'cloudbuster/gather.py', 'cloudbuster/merge.py', 'python/meta-gather.py', 'python/meta-merge.py'],
+      package_data={'cloudbuster': ['data/*.index.xz']},
+      scripts=['cloudbuster/query_rf.py', 'cloudbuster/catalog.py', 'cloudbuster/s2grid.py', 'cloudbuster/filter.py', 'cloudbuster/filter_batch.py', 'cloudbuster/local_clouds.py', 'cloudbuster/dedup.py', 'cloudbuster/gather.py', 'cloudbuster/merge.py', 'cloudbuster/pipeline.py', 'python/meta-gather.py', 'python/meta-merge.py'],
       zip_safe=False)